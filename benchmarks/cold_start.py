@@ -0,0 +1,61 @@
+"""Measure main.py cold-start cost in fresh interpreters.
+
+Reports the time to import the module and the time until the AWS clients and HTTP transport used by the first
+API calls are ready. With --live, the first real S3 request for the muting rule spreadsheet is timed as well.
+
+    python benchmarks/cold_start.py --runs 5 --max-import-ms 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.get_aws_client('s3')
+main.get_aws_client('ssm')
+main.get_transport()
+ready = time.perf_counter()
+result = {'import_ms': (imported - start) * 1000, 'first_call_ms': (ready - start) * 1000,
+          'modules': len(sys.modules)}
+if LIVE:
+    main.get_aws_client('s3').head_object(Bucket=main.BUCKET, Key='Muting Rules.xlsx')
+    result['first_response_ms'] = (time.perf_counter() - start) * 1000
+print(json.dumps(result))
+"""
+
+
+def run_probe(live):
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    output = subprocess.run([sys.executable, '-c', f'LIVE = {live}\n{PROBE}'], cwd=PACKAGE_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters to measure')
+    parser.add_argument('--live', action='store_true', help='also time the first real S3 request')
+    parser.add_argument('--max-import-ms', type=float, help='exit non-zero if the median import time is higher')
+    args = parser.parse_args()
+
+    results = [run_probe(args.live) for _ in range(args.runs)]
+    for metric in results[0]:
+        values = [result[metric] for result in results]
+        print(f'{metric}: median {statistics.median(values):.1f}, min {min(values):.1f}, max {max(values):.1f}')
+
+    median_import = statistics.median(result['import_ms'] for result in results)
+    if args.max_import_ms is not None and median_import > args.max_import_ms:
+        print(f'Import time regressed: {median_import:.1f} ms > {args.max_import_ms:.1f} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,587 @@
+"""Replay muting rule audits offline against local Monday and NerdGraph stand-ins.
+
+A scenario (a generated Muting Rules.xlsx or .csv with N clients, a Monday board of patching events and the current
+New Relic muting rules) is served from local HTTP servers with configurable latency and error rates, while S3,
+SSM and SNS are replaced by in-memory stubs. Each run times a full handler invocation (rule load, Monday fetch,
+audit, recheck and notification) and reports API call counts, retries and peak memory.
+
+Scenarios can be saved, recorded read-only from the live rule store, Monday board and New Relic rules, and
+replayed. A scenario can also pin the expected outcome of its first run (the SNS notifications and final New Relic
+rule states) and of a webhook for one edited item; replays then fail on any difference, so batching and
+concurrency changes can be regression-tested against a known-good version.
+
+    python benchmarks/replay.py --clients 200 --events 600 --runs 3
+    python benchmarks/replay.py --clients 200 --save scenario.json --update-expected
+    python benchmarks/replay.py --record recorded.json
+    python benchmarks/replay.py --replay benchmarks/scenarios/regression.json --latency-ms 40 --error-rate 0.05
+"""
+import argparse
+import base64
+import copy
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENVIRONMENTS = ['Production', 'Staging', 'Development', 'QA', 'DR']
+OTHER_STATUSES = ['Stuck', '', 'Event In Progress']
+# Clients main.py handles specially: Lenovo's weekly rows and first-upcoming-event rule, and Neighborly's patch wave
+# windows from rule_windows.csv, with the board environments their events use
+SPECIAL_RULES = [
+    ['Lenovo', 'Weekly Linux', 38493653, 2709551],
+    ['Lenovo', 'Weekly Windows', 38493686, 2709551],
+    ['Neighborly', 'Dev/QA', 38495798, 3446638],
+    ['Neighborly', 'Dev/QA', 38495968, 3446638],
+    ['Neighborly', 'Production', 38496432, 3446638],
+    ['Neighborly', 'Production', 38496605, 3446638],
+    ['Neighborly', 'Spillover', 38496729, 3446638]
+]
+SPECIAL_ENVIRONMENTS = [('Lenovo', 'Linux Group 1'), ('Lenovo', 'Linux Group 2'), ('Lenovo', 'Windows Group 1'),
+                        ('Lenovo', 'Windows Group 2'), ('Neighborly', 'Dev/QA'), ('Neighborly', 'Production'),
+                        ('Neighborly', 'Spillover')]
+
+NR_READ = re.compile(r'(\w+): account\(id: (\d+)\) \{\s*alerts \{\s*mutingRule\(id: (\d+)\)')
+NR_UPDATE = re.compile(r'(\w+): alertsMutingRuleUpdate\(accountId: (\d+), id: (\d+), rule:\s*\{enabled: (\w+)'
+                       r'(?:, schedule:\s*\{startTime: "([^"]+)", endTime: "([^"]+)"\})?')
+MONDAY_CURSOR = re.compile(r'cursor: "([^"]+)"')
+MONDAY_LIMIT = re.compile(r'limit: (\d+)')
+MONDAY_NAME = re.compile(r'column_id: "name", compare_value: \[("(?:[^"\\]|\\.)*")\]')
+MONDAY_ITEM_IDS = re.compile(r'items \(ids: \[(\d+)\]\)')
+MONDAY_UPDATED = re.compile(r'column_id: "__last_updated__", compare_value: \["EXACT", "([\d-]+)"\]')
+
+
+def generate_scenario(clients, events, seed, statuses):
+    rng = random.Random(seed)
+    today = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    muting_rules = [list(row) for row in SPECIAL_RULES]
+    nr_rules = []
+    rule_id = 100000
+    for client_index in range(clients):
+        client = f'Client {client_index + 1:04d}'
+        account = 1000000 + client_index // 4
+        for environment in rng.sample(ENVIRONMENTS, rng.randint(1, 3)):
+            for _ in range(rng.randint(1, 2)):
+                rule_id += 1
+                muting_rules.append([client, environment, rule_id, account])
+
+    for client, environment, muting_rule_id, account in muting_rules:
+        schedule = None if rng.random() < 0.2 else {
+            'startTime': f'{today - timedelta(days=rng.randint(1, 30)):%Y-%m-%dT%H:%M:%S}-05:00',
+            'endTime': f'{today - timedelta(days=rng.randint(0, 1)):%Y-%m-%dT%H:%M:%S}-05:00'
+        }
+        nr_rules.append([account, muting_rule_id, {'id': str(muting_rule_id), 'enabled': rng.random() < 0.5,
+                                                   'schedule': schedule}])
+
+    # Several events per client environment, so later events on the board override earlier ones
+    environments = sorted({(client, environment) for client, environment, _, _ in muting_rules[len(SPECIAL_RULES):]})
+    items = []
+    for item_index in range(events):
+        client, environment = rng.choice(SPECIAL_ENVIRONMENTS if rng.random() < 0.1 else environments)
+        start = today + timedelta(days=rng.randint(-7, 90), hours=rng.randint(0, 23))
+        items.append({
+            'name': client,
+            'id': str(5000000000 + item_index),
+            'updated_at': f'{today - timedelta(days=30):%Y-%m-%dT%H:%M:%SZ}',
+            'column_values': [
+                {'id': 'text', 'text': environment},
+                {'id': 'status', 'text': rng.choice(statuses)},
+                {'id': 'date2', 'text': f'{start:%Y-%m-%d %H:%M}' if rng.random() > 0.02 else ''},
+                {'id': 'numeric2', 'text': str(rng.randint(1, 8))}
+            ]
+        })
+
+    # A Monday edit to one item, replayed through webhook_handler
+    webhook_item = rng.choice(items)
+    webhook_start = today + timedelta(days=rng.randint(1, 30), hours=rng.randint(0, 23))
+    webhook = {'item_id': webhook_item['id'],
+               'column_values': {'status': rng.choice(statuses), 'date2': f'{webhook_start:%Y-%m-%d %H:%M}'}}
+
+    # An item that shows as edited while the audit runs, so the recheck reconciles its client again, and whose rule
+    # was deleted in New Relic, so both the audit and the recheck report it as not mutated
+    edited_item = rng.choice([item for item in items if item['column_values'][1]['text'] == statuses[0]] or items)
+    edited_rules = {(account, muting_rule_id) for client, environment, muting_rule_id, account in muting_rules
+                    if (client, environment) == (edited_item['name'], edited_item['column_values'][0]['text'])}
+    nr_rules = [nr_rule for nr_rule in nr_rules if (nr_rule[0], nr_rule[1]) not in edited_rules]
+
+    return {'seed': seed, 'generated_at': f'{today:%Y-%m-%dT%H:%M:%SZ}', 'muting_rules': muting_rules,
+            'items': items, 'nr_rules': nr_rules, 'webhook': webhook, 'edited_during_audit': [edited_item['id']]}
+
+
+def record_scenario(path, logger):
+    sys.path.insert(0, PACKAGE_DIR)
+    import main
+
+    # Read-only: the rule store, the Monday board and every indexed New Relic rule are fetched; nothing is written
+    muting_rules_file = main.get_aws_client('s3').get_object(Bucket=main.BUCKET, Key=main.MUTING_RULES_KEY)
+    rule_rows = main.read_rule_rows(main.MUTING_RULES_KEY, muting_rules_file['Body'].read())
+    rule_index = main.build_rule_index(rule_rows, logger)
+    items = list(main.get_patching_events(logger))
+    rule_keys = [(rule_info[1], rule_id) for rule_info in rule_index.rules.values() if rule_info
+                 for rule_id in rule_info[0]]
+    nr_headers = {'Content-Type': 'application/json', 'API-Key': main.get_api_key('new_relic', logger)}
+    nr_rules, nr_errors = main.get_nr_muting_rules(list(dict.fromkeys(rule_keys)), main.NR_ENDPOINT, nr_headers,
+                                                   logger)
+
+    def plain(value):
+        # Spreadsheet cells come back as numpy numbers or NaN
+        try:
+            return main.parse_rule_number(value)
+        except ValueError:
+            return str(value)
+
+    scenario = {
+        'generated_at': f'{datetime.now(timezone.utc):%Y-%m-%dT%H:%M:%SZ}',
+        'muting_rules': [[str(client), str(envir), plain(rule_id), plain(nr_account)]
+                         for client, envir, rule_id, nr_account in rule_rows],
+        'items': items,
+        'nr_rules': [[nr_account, rule_id, rule] for (nr_account, rule_id), rule in nr_rules.items()]
+    }
+    with open(path, 'w') as scenario_file:
+        json.dump(scenario, scenario_file)
+    print(f'Recorded {len(rule_rows)} muting rule row(s), {len(items)} event(s) and {len(nr_rules)} New Relic rule(s) '
+          f'({len(nr_errors)} not readable) to {path}')
+
+
+def compare_outcome(expected, actual):
+    mismatches = []
+    for field in sorted(set(expected) - {'nr_rules'} | set(actual) - {'nr_rules'}):
+        if expected.get(field) != actual.get(field):
+            mismatches.append(f'{field}: expected {expected.get(field)}, got {actual.get(field)}')
+    expected_rules = {(nr_account, rule_id): rule for nr_account, rule_id, rule in expected['nr_rules']}
+    actual_rules = {(nr_account, rule_id): rule for nr_account, rule_id, rule in actual['nr_rules']}
+    for rule_key in sorted(set(expected_rules) | set(actual_rules)):
+        if expected_rules.get(rule_key) != actual_rules.get(rule_key):
+            mismatches.append(f'rule {rule_key[1]} in account {rule_key[0]}: expected {expected_rules.get(rule_key)}, '
+                              f'got {actual_rules.get(rule_key)}')
+    return mismatches
+
+
+def build_rule_store(muting_rules, columns, rule_store):
+    if rule_store == 'csv':
+        rule_csv = io.StringIO()
+        writer = csv.writer(rule_csv)
+        writer.writerow(columns)
+        writer.writerows(muting_rules)
+        return rule_csv.getvalue().encode()
+
+    import pandas as pd
+
+    workbook = io.BytesIO()
+    pd.DataFrame(muting_rules, columns=columns).to_excel(workbook, index=False)
+    return workbook.getvalue()
+
+
+class FakeServer(ThreadingHTTPServer):
+    """Local GraphQL stand-in that adds latency and injects 503s at the configured rate."""
+
+    daemon_threads = True
+
+    def __init__(self, respond, latency_ms, error_rate, seed):
+        super().__init__(('127.0.0.1', 0), FakeRequestHandler)
+        self.respond = respond
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/graphql'
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+        with server.lock:
+            server.requests += 1
+            delay = server.latency * server.rng.uniform(0.5, 1.5)
+            failed = server.rng.random() < server.error_rate
+            server.errors += int(failed)
+        time.sleep(delay)
+
+        if failed:
+            status, body = 503, b'{"errors": [{"message": "Service Unavailable"}]}'
+        else:
+            status, body = 200, json.dumps(server.respond(query)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if failed:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMonday:
+    def __init__(self, items):
+        self.items = items
+        # Item IDs reported as updated just now, like an edit made while an audit is running
+        self.edited = set()
+
+    def __call__(self, query):
+        item_ids = MONDAY_ITEM_IDS.search(query)
+        if item_ids:
+            return {'data': {'items': [{'name': item['name']} for item in self.items
+                                       if item['id'] == item_ids.group(1)]}}
+
+        # Cursors encode the name and last-updated filters and an offset into the board; the date and status filters
+        # are not applied
+        limit = int(MONDAY_LIMIT.search(query).group(1))
+        cursor = MONDAY_CURSOR.search(query)
+        if cursor:
+            name, updated_since, offset = json.loads(base64.urlsafe_b64decode(cursor.group(1)))
+        else:
+            name = MONDAY_NAME.search(query)
+            updated_since = MONDAY_UPDATED.search(query)
+            name, updated_since, offset = json.loads(name.group(1)) if name else None, \
+                updated_since.group(1) if updated_since else None, 0
+        now = f'{datetime.now(timezone.utc):%Y-%m-%dT%H:%M:%S.%fZ}'
+        items = [dict(item, updated_at=now) if item['id'] in self.edited else item for item in self.items]
+        items = [item for item in items if (not name or name.casefold() in item['name'].casefold()) and
+                 (not updated_since or item.get('updated_at', '')[:10] >= updated_since)]
+        next_cursor = base64.urlsafe_b64encode(json.dumps([name, updated_since, offset + limit]).encode()).decode()
+        items_page = {'cursor': next_cursor if offset + limit < len(items) else None,
+                      'items': items[offset:offset + limit]}
+        if cursor:
+            return {'data': {'next_items_page': items_page}}
+        return {'data': {'boards': [{'items_page': items_page}]}}
+
+
+class FakeNerdGraph:
+    def __init__(self, nr_rules):
+        self.lock = threading.Lock()
+        self.load(nr_rules)
+
+    def load(self, nr_rules):
+        with self.lock:
+            self.rules = {(account, rule_id): copy.deepcopy(rule) for account, rule_id, rule in nr_rules}
+
+    def dump(self):
+        with self.lock:
+            return [[account, rule_id, copy.deepcopy(rule)] for (account, rule_id), rule in sorted(self.rules.items())]
+
+    def __call__(self, query):
+        data = {}
+        errors = []
+        with self.lock:
+            if query.lstrip().startswith('mutation'):
+                for alias, account, rule_id, enabled, start_time, end_time in NR_UPDATE.findall(query):
+                    rule = self.rules.get((int(account), int(rule_id)))
+                    if rule is None:
+                        data[alias] = None
+                        errors.append({'message': f'Muting rule {rule_id} not found', 'path': [alias]})
+                        continue
+                    rule['enabled'] = enabled == 'true'
+                    if start_time:
+                        rule['schedule'] = {'startTime': f'{start_time}-05:00', 'endTime': f'{end_time}-05:00'}
+                    data[alias] = {'id': rule_id}
+                return {'data': data, **({'errors': errors} if errors else {})}
+
+            for alias, account, rule_id in NR_READ.findall(query):
+                rule = self.rules.get((int(account), int(rule_id)))
+                data[alias] = {'alerts': {'mutingRule': copy.deepcopy(rule)}}
+                if rule is None:
+                    errors.append({'message': f'Muting rule {rule_id} not found',
+                                   'path': ['actor', alias, 'alerts', 'mutingRule']})
+        return {'data': {'actor': data}, **({'errors': errors} if errors else {})}
+
+
+class StubAwsClient:
+    """In-memory S3/SSM/SNS calls that report to main.run_metrics like the boto clients do."""
+
+    def __init__(self, service, main):
+        self.service = service
+        self.main = main
+        self.objects = {}
+        self.messages = []
+
+    def record(self, operation, start, failed=False):
+        self.main.run_metrics.record_call(f'{self.service}.{operation}', time.perf_counter() - start, failed=failed)
+
+    def client_error(self, operation, code, status):
+        from botocore.exceptions import ClientError
+        return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        start = time.perf_counter()
+        self.objects[(Bucket, Key)] = (Body, f'"{hashlib.md5(Body).hexdigest()}"', datetime.now(timezone.utc))
+        self.record('PutObject', start)
+        return {'ETag': self.objects[(Bucket, Key)][1]}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        start = time.perf_counter()
+        if (Bucket, Key) not in self.objects:
+            self.record('GetObject', start, failed=True)
+            raise self.client_error('GetObject', 'NoSuchKey', 404)
+        body, etag, last_modified = self.objects[(Bucket, Key)]
+        if IfNoneMatch == etag:
+            self.record('GetObject', start)
+            raise self.client_error('GetObject', '304', 304)
+        self.record('GetObject', start)
+        return {'Body': io.BytesIO(body), 'ETag': etag, 'LastModified': last_modified}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        start = time.perf_counter()
+        self.record('GetParameters', start)
+        return {'Parameters': [{'Name': name, 'Value': 'offline-key'} for name in Names], 'InvalidParameters': []}
+
+    def publish(self, TopicArn, Subject, Message):
+        start = time.perf_counter()
+        self.messages.append({'Subject': Subject, 'Message': Message})
+        self.record('Publish', start)
+        return {'MessageId': str(len(self.messages))}
+
+
+def import_main(monday, nerdgraph, workdir, args):
+    # main.py reads its configuration at import time
+    os.environ.update({
+        'MONDAY_ENDPOINT': monday.url,
+        'NR_ENDPOINT': nerdgraph.url,
+        'NR_ACCOUNT_REQUESTS_PER_SECOND': str(args.nr_rate),
+        'RULE_CACHE_PATH': os.path.join(workdir, 'muting_rules_cache.json'),
+        'SNAPSHOT_STORE': args.snapshot,
+        'MUTING_RULES_KEY': f'Muting Rules.{args.rule_store}',
+        'SNAPSHOT_PATH': os.path.join(workdir, 'rule_snapshot.json'),
+        'METRICS_FORMAT': 'off',
+        # Notifications are compared with the expected outcome, so they leave out the run's timings
+        'METRICS_IN_NOTIFICATION': 'false',
+        'LOG_LEVEL': 'INFO' if args.verbose else 'ERROR'
+    })
+    sys.path.insert(0, PACKAGE_DIR)
+    import main
+    return main
+
+
+def reset_caches(main):
+    main.rule_cache.clear()
+    main.api_key_cache.clear()
+    if main.RULE_CACHE_PATH and os.path.exists(main.RULE_CACHE_PATH):
+        os.remove(main.RULE_CACHE_PATH)
+    reset_snapshot(main)
+
+
+def reset_snapshot(main):
+    if main.SNAPSHOT_PATH and os.path.exists(main.SNAPSHOT_PATH):
+        os.remove(main.SNAPSHOT_PATH)
+    main.aws_clients['s3'].objects.pop((main.BUCKET, main.SNAPSHOT_KEY), None)
+
+
+def run_once(main, args, nerdgraph_state):
+    sns = main.aws_clients['sns']
+    sent = len(sns.messages)
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    response = main.handler({'dry_run': args.dry_run}, None)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if args.memory else None
+    if args.memory:
+        tracemalloc.stop()
+
+    report = main.run_metrics.report()
+    calls = {'monday': 0, 'nerdgraph': 0, 'aws': 0, 'retries': 0}
+    for endpoint, stats in report['endpoints'].items():
+        api = 'monday' if endpoint == main.MONDAY_ENDPOINT else 'nerdgraph' if endpoint == main.NR_ENDPOINT \
+            else 'aws'
+        calls[api] += stats['calls']
+        calls['retries'] += stats['retries']
+    if args.dry_run:
+        response = {'process_code': 0, 'changes': len(response['changes'])}
+    return {
+        'seconds': round(elapsed, 3),
+        'peak_mib': round(peak / 2 ** 20, 1) if peak is not None else None,
+        'process_code': response['process_code'],
+        'changes': response['changes'],
+        'rules_not_mutated': len(response['rule_ids_not_mutated']) if response['process_code'] == 0 and
+        not args.dry_run else None,
+        'events_not_processed': len(response['events_not_processed']) if not args.dry_run else None,
+        'calls': calls,
+        'metrics': report,
+        'outcome': {'notifications': sns.messages[sent:], 'nr_rules': nerdgraph_state.dump()}
+    }
+
+
+def replay_webhook(main, scenario, board, nerdgraph_state):
+    # The edited item is replayed against the scenario's original rules, so its outcome does not depend on the runs
+    webhook = scenario['webhook']
+    nerdgraph_state.load(scenario['nr_rules'])
+    board.items = copy.deepcopy(scenario['items'])
+    item = next(item for item in board.items if item['id'] == webhook['item_id'])
+    for column in item['column_values']:
+        column['text'] = webhook['column_values'].get(column['id'], column['text'])
+
+    sns = main.aws_clients['sns']
+    sent = len(sns.messages)
+    response = main.webhook_handler({'body': json.dumps({'event': {
+        'type': 'update_column_value', 'boardId': main.MONDAY_BOARD_ID, 'pulseId': int(item['id']),
+        'pulseName': item['name']
+    }})}, None)
+    board.items = scenario['items']
+    # API Gateway can also pass bodies that are not JSON objects, which are ignored
+    ignored_response = main.webhook_handler({'body': 'null'}, None)
+    return {'response': json.loads(response['body']), 'ignored_response': json.loads(ignored_response['body']),
+            'notifications': sns.messages[sent:], 'nr_rules': nerdgraph_state.dump()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=100, help='clients in the generated Muting Rules.xlsx')
+    parser.add_argument('--events', type=int, help='patching events on the generated board (default 3 per client)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated scenario and injected errors')
+    parser.add_argument('--save', help='write the scenario to this JSON file')
+    parser.add_argument('--replay', help='replay a scenario JSON file (from --save or --record) instead of '
+                                         'generating one')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record the live rule store, Monday board and New Relic rules to a scenario file '
+                             '(read-only; needs AWS credentials) and exit')
+    parser.add_argument('--update-expected', action='store_true',
+                        help='pin the outcome of the first run and of the scenario\'s webhook as the expected outcome '
+                     'in the --replay or --save file')
+    parser.add_argument('--runs', type=int, default=3, help='consecutive audits against the same stand-ins')
+    parser.add_argument('--latency-ms', type=float, default=0, help='mean latency added to every fake API response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of fake API responses that are 503s')
+    parser.add_argument('--nr-rate', type=float, default=0,
+                        help='NerdGraph requests per second per account (0 disables the limiter)')
+    parser.add_argument('--rule-store', choices=['xlsx', 'csv'], default='xlsx',
+                        help='serve the muting rules as the legacy spreadsheet or the CSV rule store')
+    parser.add_argument('--snapshot', choices=['s3', 'tmp', 'off'], default='s3', help='muting rule snapshot store')
+    parser.add_argument('--reset-rules', action='store_true',
+                        help='restore the scenario\'s New Relic rules before every run instead of letting runs '
+                             'converge')
+    parser.add_argument('--cold', action='store_true', help='clear the rule, key and snapshot caches before every run')
+    parser.add_argument('--dry-run', action='store_true', help='plan changes without writing them')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip tracemalloc, which slows the run down, when only timings matter')
+    parser.add_argument('--json', action='store_true', help='print every run report as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the audit log')
+    parser.add_argument('--max-seconds', type=float, help='exit non-zero if the median run time is higher')
+    parser.add_argument('--max-nr-calls', type=int, help='exit non-zero if the first run makes more NerdGraph calls')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO if args.verbose else logging.ERROR)
+    logger = logging.getLogger('replay')
+
+    if args.record:
+        record_scenario(args.record, logger)
+        return
+    if args.update_expected and not (args.replay or args.save) or args.update_expected and args.dry_run:
+        parser.error('--update-expected needs --replay or --save and cannot be combined with --dry-run')
+
+    # The stand-ins start first because main.py needs their URLs before it is imported
+    board = FakeMonday([])
+    nerdgraph_state = FakeNerdGraph([])
+    monday = FakeServer(board, args.latency_ms, args.error_rate, args.seed)
+    nerdgraph = FakeServer(nerdgraph_state, args.latency_ms, args.error_rate, args.seed + 1)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        main_module = import_main(monday, nerdgraph, workdir, args)
+
+        if args.replay:
+            with open(args.replay) as scenario_file:
+                scenario = json.load(scenario_file)
+        else:
+            scenario = generate_scenario(args.clients, args.events if args.events is not None else args.clients * 3,
+                                         args.seed, main_module.ACTIVE_STATUSES + main_module.INACTIVE_STATUSES +
+                                         OTHER_STATUSES)
+        board.items = scenario['items']
+        board.edited = set(scenario.get('edited_during_audit', []))
+        nerdgraph_state.load(scenario['nr_rules'])
+
+        main_module.aws_clients.update({service: StubAwsClient(service, main_module)
+                                        for service in ['s3', 'ssm', 'sns']})
+        main_module.aws_clients['s3'].put_object(Bucket=main_module.BUCKET, Key=main_module.MUTING_RULES_KEY,
+                                                 Body=build_rule_store(scenario['muting_rules'],
+                                                                       main_module.RULE_COLUMNS, args.rule_store))
+        print(f'Scenario: {len(scenario["muting_rules"])} muting rule(s), {len(scenario["items"])} event(s), '
+              f'{len(scenario["nr_rules"])} New Relic rule(s)')
+
+        results = []
+        mismatches = []
+        for run in range(args.runs):
+            if args.reset_rules:
+                nerdgraph_state.load(scenario['nr_rules'])
+                reset_snapshot(main_module)
+            if args.cold:
+                reset_caches(main_module)
+            result = run_once(main_module, args, nerdgraph_state)
+            results.append(result)
+
+            # Only runs that start from the scenario's rules can be compared with its expected outcome
+            if scenario.get('expected') and not args.dry_run and not args.update_expected and \
+                    (run == 0 or args.reset_rules):
+                run_mismatches = compare_outcome(scenario['expected']['sweep'], result['outcome'])
+                mismatches.extend(f'run {run + 1}: {mismatch}' for mismatch in run_mismatches)
+            memory = f', peak {result["peak_mib"]} MiB' if result['peak_mib'] is not None else ''
+            print(f'run {run + 1}: {result["seconds"]:.3f}s{memory}, {result["calls"]["monday"]} Monday / '
+                  f'{result["calls"]["nerdgraph"]} NerdGraph / {result["calls"]["aws"]} AWS call(s), '
+                  f'{result["calls"]["retries"]} retried, {result["changes"]} change(s), '
+                  f'{result["rules_not_mutated"]} rule(s) not mutated, '
+                  f'{result["events_not_processed"]} event(s) not processed')
+            if args.json:
+                print(json.dumps({key: value for key, value in result.items() if key != 'outcome'}))
+
+        if scenario.get('webhook') and not args.dry_run and (args.update_expected or scenario.get('expected')):
+            webhook_outcome = replay_webhook(main_module, scenario, board, nerdgraph_state)
+            print(f'webhook: {webhook_outcome["response"]}')
+            if args.update_expected:
+                scenario['expected'] = {'sweep': results[0]['outcome'], 'webhook': webhook_outcome}
+            elif 'webhook' in scenario['expected']:
+                mismatches.extend(f'webhook: {mismatch}'
+                                  for mismatch in compare_outcome(scenario['expected']['webhook'], webhook_outcome))
+        elif args.update_expected:
+            scenario['expected'] = {'sweep': results[0]['outcome']}
+        if args.save or args.update_expected:
+            with open(args.save or args.replay, 'w') as scenario_file:
+                json.dump(scenario, scenario_file)
+
+    print(f'Fake servers: Monday {monday.requests} request(s) ({monday.errors} injected error(s)), '
+          f'NerdGraph {nerdgraph.requests} request(s) ({nerdgraph.errors} injected error(s))')
+    monday.shutdown()
+    nerdgraph.shutdown()
+
+    median_seconds = statistics.median(result['seconds'] for result in results)
+    print(f'seconds: median {median_seconds:.3f}, min {min(r["seconds"] for r in results):.3f}, '
+          f'max {max(r["seconds"] for r in results):.3f}')
+    if args.max_seconds is not None and median_seconds > args.max_seconds:
+        print(f'Run time regressed: {median_seconds:.3f}s > {args.max_seconds:.3f}s')
+        sys.exit(1)
+    if args.max_nr_calls is not None and results[0]['calls']['nerdgraph'] > args.max_nr_calls:
+        print(f'NerdGraph calls regressed: {results[0]["calls"]["nerdgraph"]} > {args.max_nr_calls}')
+        sys.exit(1)
+    if args.update_expected:
+        print(f'Expected outcome of run 1 saved to {args.save or args.replay}')
+    elif scenario.get('expected') and not args.dry_run:
+        for mismatch in mismatches[:20]:
+            print(mismatch)
+        if mismatches:
+            print(f'Outcome regressed: {len(mismatches)} difference(s) from the expected outcome')
+            sys.exit(1)
+        print('Outcome matches the expected outcome')
+
+
+if __name__ == '__main__':
+    main()
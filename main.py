@@ -1,196 +1,893 @@
-from datetime import datetime, timedelta
-import pandas as pd
+from datetime import datetime, timedelta, timezone
 from string import Template
-import requests
 import sys
 import logging
-import boto3
-from botocore import exceptions
 import io
+import csv
+import base64
+import hashlib
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from traceback import print_exc
+from collections import namedtuple
+from contextlib import contextmanager
+from types import MappingProxyType
 
-session = boto3.Session()
-s3 = session.client('s3')
-ssm = session.client('ssm')
-sns = session.client('sns')
+# pandas, requests and boto3 are imported on first use to keep cold starts short;
+# AWS clients are created once per container and reused by warm invocations
+aws_session = None
+aws_clients = {}
+aws_clients_lock = threading.Lock()
 
-BUCKET = '2w-nr-muting-rules-automation'
-TOPIC_ARN = 'arn:aws:sns:us-east-1:187940856853:2w-nr-muting-rules-automation-topic'
+BUCKET = os.environ.get('BUCKET', '2w-nr-muting-rules-automation')
+TOPIC_ARN = os.environ.get('TOPIC_ARN', 'arn:aws:sns:us-east-1:187940856853:2w-nr-muting-rules-automation-topic')
+# Muting rule store in BUCKET: a compact .csv written by --convert-rules, or the legacy .xlsx spreadsheet
+MUTING_RULES_KEY = os.environ.get('MUTING_RULES_KEY', 'Muting Rules.xlsx')
+
+# Decrypted API keys reused across warm invocations until the TTL (seconds) expires
+api_key_cache = {}
+api_key_lock = threading.Lock()
+API_KEY_TTL_SECONDS = float(os.environ.get('API_KEY_TTL_SECONDS', 900))
+
+# Parsed muting rule index reused across warm invocations, and an optional on-disk copy for new containers
+rule_cache = {}
+RULE_CACHE_PATH = os.environ.get('RULE_CACHE_PATH', '/tmp/muting_rules_cache.json')
+
+# Monday board paging and the window of event dates fetched around today (blank for no bound)
+MONDAY_ENDPOINT = os.environ.get('MONDAY_ENDPOINT', 'https://api.monday.com/v2')
+MONDAY_BOARD_ID = int(os.environ.get('MONDAY_BOARD_ID', 413857267))
+MONDAY_API_VERSION = os.environ.get('MONDAY_API_VERSION', '2024-10')
+MONDAY_PAGE_SIZE = int(os.environ.get('MONDAY_PAGE_SIZE', 100))
+MONDAY_LOOKBACK_DAYS = os.environ.get('MONDAY_LOOKBACK_DAYS', '7')
+MONDAY_LOOKAHEAD_DAYS = os.environ.get('MONDAY_LOOKAHEAD_DAYS', '90')
+# Comma-separated status label indexes that never need processing
+MONDAY_EXCLUDED_STATUS_INDEXES = os.environ.get('MONDAY_EXCLUDED_STATUS_INDEXES', '')
+
+# Where the last applied state of every rule is kept between runs ('s3', 'tmp' or 'off'), and how often every
+# rule is read from New Relic regardless to catch manual edits
+SNAPSHOT_STORE = os.environ.get('SNAPSHOT_STORE', 's3')
+SNAPSHOT_KEY = os.environ.get('SNAPSHOT_KEY', 'Rule Snapshot.json')
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', '/tmp/rule_snapshot.json')
+SNAPSHOT_VERIFY_HOURS = float(os.environ.get('SNAPSHOT_VERIFY_HOURS', 24 * 7))
+
+# NerdGraph endpoint; like MONDAY_ENDPOINT it can point at a local stand-in (see benchmarks/replay.py)
+NR_ENDPOINT = os.environ.get('NR_ENDPOINT', 'https://api.newrelic.com/graphql')
+# Number of muting rules read per aliased NerdGraph query
+NR_QUERY_CHUNK_SIZE = int(os.environ.get('NR_QUERY_CHUNK_SIZE', 25))
+# Number of muting rule updates sent per aliased NerdGraph mutation
+NR_MUTATION_CHUNK_SIZE = int(os.environ.get('NR_MUTATION_CHUNK_SIZE', 25))
+# Worker threads used to process events and the per-account NerdGraph request rate they share
+NR_MAX_WORKERS = int(os.environ.get('NR_MAX_WORKERS', 8))
+NR_ACCOUNT_REQUESTS_PER_SECOND = float(os.environ.get('NR_ACCOUNT_REQUESTS_PER_SECOND', 5))
+
+# Shared HTTP transport timeouts (seconds) and retry policy for 429/5xx and GraphQL rate-limit errors
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 4))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', 0.5))
+# Longest single wait between retries, including a server's Retry-After, so a long 429 cannot outlast the function
+HTTP_MAX_RETRY_DELAY = float(os.environ.get('HTTP_MAX_RETRY_DELAY', HTTP_BACKOFF_BASE * 2 ** HTTP_MAX_RETRIES))
+
+# Run metrics output ('emf' for CloudWatch embedded metrics, 'json' for a log line, or 'off'), whether the summary
+# is added to the notification, and the fraction of full API responses dumped to the log
+METRICS_FORMAT = os.environ.get('METRICS_FORMAT', 'emf')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MutingRuleAudit')
+METRICS_IN_NOTIFICATION = os.environ.get('METRICS_IN_NOTIFICATION', 'true').lower() in ['1', 'true', 'yes']
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', 0))
+# Level of this function's own log output; library loggers stay at WARNING
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Time format New Relic muting rule schedules are compared and written in
+NR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Per-rule window length and start delta (hours) that replace the event's window, e.g. Neighborly's patch waves
+RULE_WINDOWS_PATH = os.environ.get('RULE_WINDOWS_PATH',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rule_windows.csv'))
+
+# Plan the muting rule changes without writing them
+DRY_RUN = os.environ.get('DRY_RUN', '').lower() in ['1', 'true', 'yes']
+
+# Optional JSON file of board/account shards that handler audits in parallel (see load_shard_config), whether
+# shards run as forked worker processes ('process') or synchronous invocations of this function ('lambda'), and
+# how many run at once
+SHARD_CONFIG_PATH = os.environ.get('SHARD_CONFIG_PATH', '')
+SHARD_MODE = os.environ.get('SHARD_MODE', 'process')
+SHARD_MAX_WORKERS = int(os.environ.get('SHARD_MAX_WORKERS', 4))
+
+ACTIVE_STATUSES = ['Event Prep In Progress', 'To-Do', 'Event Scheduled']
+INACTIVE_STATUSES = ['Event Complete', 'Paused/On-Hold', 'All Compliant', 'Event Failed', 'Event Cancelled',
+                     'Engineering Team Assigned', 'Event to be Rescheduled', 'Awaiting Approval/Review']
+
+# Rule store headers for the client, environment, muting rule ID and New Relic account, in that order
+RULE_COLUMNS = os.environ.get('RULE_COLUMNS', 'Client,Environment,Muting Rule ID,NR Account #').split(',')
+CLIENTS_WITHOUT_MUTING = ['Ollion Infra', 'Gas Station TV', 'Michael Kors', 'NAIC', 'Symetra', 'TitleMax',
+                          'Rayonier AM', 'test']
+# Monday environment names containing the first value are looked up under the second, checked in order
+ENVIRONMENT_ALIASES = {
+    'Lenovo': [('Linux', 'Weekly Linux'), ('Windows', 'Weekly Windows')]
+}
+# Clients whose weekly events share rules, so only their first upcoming event that changes a rule is applied
+FIRST_EVENT_CLIENTS = ['Lenovo']
+# Audit settings a shard config may override; anything a shard leaves out keeps its deployment default
+SHARD_SETTINGS = ['board_id', 'bucket', 'rules_key', 'clients_without_muting', 'environment_aliases',
+                  'first_event_clients', 'rule_windows_path', 'accounts', 'account_group']
+
+MutingRuleIndex = namedtuple('MutingRuleIndex', ['rules', 'skip_clients', 'aliases', 'first_event_clients',
+                                                 'diagnostics'])
+# Where one audit reads its board, rules and snapshot from, passed to the functions of that run so a warm container
+# can audit a different shard next. accounts and account_group limit the audit to an explicit set of New Relic
+# accounts and/or an [index, count] group of account numbers modulo count (None for every account).
+AuditSettings = namedtuple('AuditSettings', ['board_id', 'bucket', 'rules_key', 'clients_without_muting',
+                                             'environment_aliases', 'first_event_clients', 'rule_windows_path',
+                                             'accounts', 'account_group', 'snapshot_key', 'snapshot_path',
+                                             'rule_cache_path'])
+DEFAULT_SETTINGS = AuditSettings(board_id=MONDAY_BOARD_ID, bucket=BUCKET, rules_key=MUTING_RULES_KEY,
+                                 clients_without_muting=CLIENTS_WITHOUT_MUTING,
+                                 environment_aliases=ENVIRONMENT_ALIASES, first_event_clients=FIRST_EVENT_CLIENTS,
+                                 rule_windows_path=RULE_WINDOWS_PATH, accounts=None, account_group=None,
+                                 snapshot_key=SNAPSHOT_KEY, snapshot_path=SNAPSHOT_PATH,
+                                 rule_cache_path=RULE_CACHE_PATH)
+
+
+class RunMetrics:
+    """Per-invocation phase timings and per-endpoint call statistics for the HTTP and AWS clients."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.phases = {}
+            self.phase_stack = []
+            self.endpoints = {}
+
+    @contextmanager
+    def phase(self, name):
+        # Phases nest; time spent in an inner phase is not counted again in the outer one
+        with self.lock:
+            now = time.perf_counter()
+            if self.phase_stack:
+                self.accrue(self.phase_stack[-1], now)
+            self.phase_stack.append([name, now])
+            self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        try:
+            yield
+        finally:
+            with self.lock:
+                now = time.perf_counter()
+                self.accrue(self.phase_stack.pop(), now)
+                if self.phase_stack:
+                    self.phase_stack[-1][1] = now
+
+    def accrue(self, phase, now):
+        self.phases[phase[0]]['seconds'] += now - phase[1]
+        phase[1] = now
+
+    def record_call(self, endpoint, latency, bytes_sent=0, bytes_received=0, retried=False, failed=False):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {'calls': 0, 'retries': 0, 'errors': 0, 'bytes_sent': 0,
+                                                         'bytes_received': 0, 'latencies': []})
+            stats['calls'] += 1
+            stats['retries'] += int(retried)
+            stats['errors'] += int(failed)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['latencies'].append(latency)
+            if self.phase_stack:
+                self.phases[self.phase_stack[-1][0]]['calls'] += 1
+
+    def before_aws_call(self, context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    def after_aws_call(self, http_response, model, context, **kwargs):
+        latency = time.perf_counter() - context.get('metrics_started', time.perf_counter())
+        self.record_call(f'{model.service_model.service_name}.{model.name}', latency,
+                         bytes_received=int(http_response.headers.get('content-length') or 0),
+                         failed=http_response.status_code >= 400)
+
+    def report(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                latencies = sorted(stats['latencies'])
+                percentiles = statistics.quantiles(latencies, n=100, method='inclusive') \
+                    if len(latencies) > 1 else latencies * 99
+                endpoints[endpoint] = {key: value for key, value in stats.items() if key != 'latencies'}
+                endpoints[endpoint].update({'p50_ms': round(percentiles[49] * 1000, 1),
+                                            'p95_ms': round(percentiles[94] * 1000, 1),
+                                            'p99_ms': round(percentiles[98] * 1000, 1),
+                                            'max_ms': round(latencies[-1] * 1000, 1)})
+            return {
+                'total_seconds': round(time.perf_counter() - self.started, 3),
+                'phases': {name: {'seconds': round(phase['seconds'], 3), 'calls': phase['calls']}
+                           for name, phase in self.phases.items()},
+                'endpoints': endpoints
+            }
+
+    def summary(self):
+        report = self.report()
+        lines = [f'Total: {report["total_seconds"]}s']
+        lines += [f'{name}: {phase["seconds"]}s, {phase["calls"]} call(s)' for name, phase in report['phases'].items()]
+        lines += [f'{endpoint}: {stats["calls"]} call(s), {stats["retries"]} retried, {stats["errors"]} failed, '
+                  f'{stats["bytes_received"]} bytes received, p50 {stats["p50_ms"]}ms, p95 {stats["p95_ms"]}ms, '
+                  f'p99 {stats["p99_ms"]}ms' for endpoint, stats in report['endpoints'].items()]
+        return '\n'.join(lines)
+
+    def emit(self, logger, mode=None):
+        report = self.report()
+        report['mode'] = mode or 'daily'
+        if METRICS_FORMAT == 'emf':
+            # CloudWatch embedded metric format; the full report rides along as log properties
+            names = {name: name.title().replace('_', '') for name in report['phases']}
+            metrics = {f'{names[name]}Seconds': phase['seconds'] for name, phase in report['phases'].items()}
+            metrics.update({f'{names[name]}Calls': phase['calls'] for name, phase in report['phases'].items()})
+            metrics['TotalSeconds'] = report['total_seconds']
+            print(json.dumps({
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['Mode']],
+                        'Metrics': [{'Name': name, 'Unit': 'Seconds' if name.endswith('Seconds') else 'Count'}
+                                    for name in metrics]
+                    }]
+                },
+                'Mode': report['mode'],
+                **metrics,
+                'report': report
+            }), flush=True)
+        elif METRICS_FORMAT == 'json':
+            logger.info(json.dumps({'run_metrics': report}))
+        return report
+
+
+run_metrics = RunMetrics()
+
+
+def log_api_response(logger, api, response):
+    # Formatting whole API responses is itself costly, so only a sample of them is dumped
+    if DEBUG_SAMPLE_RATE and random.random() < DEBUG_SAMPLE_RATE:
+        logger.info(f'{api} API response:\n{response}')
+
+
+class HttpTransport:
+    """Keep-alive session shared by the Monday and New Relic clients with timeouts and retries."""
+
+    retry_statuses = {429, 500, 502, 503, 504}
+    rate_limit_codes = {'TOO_MANY_REQUESTS', 'RATE_LIMIT_EXCEEDED', 'ComplexityException'}
+
+    def __init__(self, pool_size=NR_MAX_WORKERS, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 max_retries=HTTP_MAX_RETRIES, backoff_base=HTTP_BACKOFF_BASE, max_retry_delay=HTTP_MAX_RETRY_DELAY):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        self.retry_exceptions = (requests.ConnectionError, requests.Timeout)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(pool_size, 1))
+        self.session.mount('https://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_retry_delay = max_retry_delay
+
+    def is_rate_limited(self, body):
+        for error in body.get('errors') or []:
+            extensions = error.get('extensions') or {}
+            codes = {extensions.get('code'), extensions.get('errorClass'), error.get('error_code')}
+            if codes & self.rate_limit_codes or 'rate limit' in str(error.get('message', '')).lower():
+                return True
+        return False
+
+    def request(self, method, url, headers, payload, logger):
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                response = self.session.request(method, url, headers=headers, json=payload, timeout=self.timeout)
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = None
+                if response.status_code in self.retry_statuses:
+                    reason = f'HTTP {response.status_code}'
+                elif isinstance(body, dict) and self.is_rate_limited(body):
+                    reason = 'GraphQL rate limit'
+                else:
+                    reason = None
+                retry = reason is not None
+                retry_after = response.headers.get('Retry-After')
+                bytes_received = len(response.content)
+                error = None
+            except self.retry_exceptions as e:
+                retry = True
+                reason = e.__class__.__name__
+                bytes_received = 0
+                error = e
+            retrying = retry and attempt < self.max_retries
+            run_metrics.record_call(url, time.perf_counter() - start, len(json.dumps(payload)), bytes_received,
+                                    retrying, retry and not retrying)
+
+            if not retrying:
+                if error:
+                    raise error
+                return body if body is not None else response.json()
+
+            # Exponential backoff with full jitter, unless the server says how long to wait; either is capped
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+            delay = min(max(delay, 0.0), self.max_retry_delay)
+            attempt += 1
+            logger.warning(f'   {method} {url} failed ({reason}); '
+                           f'retry {attempt} of {self.max_retries} in {delay:.2f}s...')
+            time.sleep(delay)
+
+
+transport = None
+
+
+def get_transport():
+    global transport
+    with aws_clients_lock:
+        if transport is None:
+            transport = HttpTransport()
+        return transport
+
+
+def get_aws_client(service):
+    global aws_session
+    with aws_clients_lock:
+        if service not in aws_clients:
+            if aws_session is None:
+                import boto3
+                aws_session = boto3.Session()
+            config = None
+            if service == 'lambda':
+                from botocore.config import Config
+                # Shard invocations are synchronous and can run up to the function timeout; never retry them
+                config = Config(read_timeout=900, retries={'max_attempts': 0})
+            aws_clients[service] = aws_session.client(service, config=config)
+            aws_clients[service].meta.events.register('before-call', run_metrics.before_aws_call)
+            aws_clients[service].meta.events.register('after-call', run_metrics.after_aws_call)
+        return aws_clients[service]
 
 
 def initialize_logger():
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL)
+    # botocore logs raw response bodies at DEBUG, including the decrypted API keys from Parameter Store, and urllib3
+    # logs every request; sampled log_api_response dumps are the only full payloads written
+    for library in ['botocore', 'boto3', 's3transfer', 'urllib3']:
+        logging.getLogger(library).setLevel(logging.WARNING)
 
     return logger
 
 
-def get_stored_rule_data(logger):
+def invalidate_rule_cache(logger, settings=DEFAULT_SETTINGS):
+    logger.info('   Invalidating cached muting rule data...')
+    rule_cache.pop((settings.bucket, settings.rules_key), None)
+    if settings.rule_cache_path:
+        try:
+            os.remove(settings.rule_cache_path)
+        except FileNotFoundError:
+            pass
+
+
+def read_rule_cache_file(etag, logger, settings=DEFAULT_SETTINGS):
+    if not settings.rule_cache_path:
+        return None
+    try:
+        with open(settings.rule_cache_path) as cache_file:
+            cached = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f'   Muting rule cache file could not be read: {e}')
+        return None
+    if cached.get('etag') != etag:
+        return None
+
+    rules = {(client_key, envir_key): (tuple(rule_ids), nr_account) if rule_ids is not None else None
+             for client_key, envir_key, rule_ids, nr_account in cached['rules']}
+    return create_rule_index(rules, cached['diagnostics'], settings)
+
+
+def write_rule_cache_file(etag, last_modified, rule_index, logger, settings=DEFAULT_SETTINGS):
+    if not settings.rule_cache_path:
+        return
+    cached = {
+        'etag': etag,
+        'last_modified': str(last_modified),
+        'rules': [[client_key, envir_key, *(rule_info if rule_info is not None else (None, None))]
+                  for (client_key, envir_key), rule_info in rule_index.rules.items()],
+        'diagnostics': list(rule_index.diagnostics)
+    }
+    try:
+        with open(f'{settings.rule_cache_path}.tmp', 'w') as cache_file:
+            json.dump(cached, cache_file, separators=(',', ':'))
+        os.replace(f'{settings.rule_cache_path}.tmp', settings.rule_cache_path)
+    except OSError as e:
+        logger.warning(f'   Muting rule cache file could not be written: {e}')
+
+
+def read_rule_rows(key, data):
+    # The CSV store is parsed with the standard library; only the legacy spreadsheet needs pandas and openpyxl
+    if key.lower().endswith('.csv'):
+        reader = csv.DictReader(io.StringIO(data.decode('utf-8-sig')))
+        return [tuple(row[column] for column in RULE_COLUMNS) for row in reader]
+
+    import pandas as pd
+    muting_df = pd.read_excel(io.BytesIO(data), usecols=RULE_COLUMNS)
+    return list(muting_df[RULE_COLUMNS].itertuples(index=False, name=None))
+
+
+def parse_rule_number(value):
+    # Spreadsheet cells arrive as ints, floats (when the column has blanks) or text; blanks are None
+    if value is None or (isinstance(value, float) and value != value) or not str(value).strip():
+        return None
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    return int(str(value).strip())
+
+
+def validate_rule_rows(rule_rows):
+    rows = []
+    errors = []
+    warnings = []
+    seen_rows = set()
+    rule_owners = {}
+    group_names = {}
+    group_accounts = {}
+    group_blanks = {}
+    for line, (client, envir, rule_id, nr_account) in enumerate(rule_rows, start=2):
+        client = str(client).strip() if client == client and client is not None else ''
+        envir = str(envir).strip() if envir == envir and envir is not None else ''
+        if not client or not envir:
+            errors.append(f'Row {line}: missing client or environment ({client!r}, {envir!r}).')
+            continue
+        try:
+            rule_id = parse_rule_number(rule_id)
+        except ValueError:
+            errors.append(f'Row {line}: {client} {envir} has a non-integer muting rule ID {rule_id!r}.')
+            continue
+        try:
+            nr_account = parse_rule_number(nr_account)
+        except ValueError:
+            errors.append(f'Row {line}: {client} {envir} has a non-integer NR account {nr_account!r}.')
+            continue
+
+        key = (normalize_key(client), normalize_key(envir))
+        if (key, rule_id, nr_account) in seen_rows:
+            warnings.append(f'Row {line}: duplicate of an earlier row for {client} {envir}; dropped.')
+            continue
+        seen_rows.add((key, rule_id, nr_account))
+        rows.append((client, envir, rule_id, nr_account))
+        group_names.setdefault(key, f'{client} {envir}')
+
+        if rule_id is None:
+            warnings.append(f'Row {line}: {client} {envir} has no muting rule ID; it will be reported as having no '
+                            f'muting rule in place.')
+            group_blanks.setdefault(key, line)
+            continue
+        if nr_account is None:
+            errors.append(f'Row {line}: {client} {envir} muting rule {rule_id} has no NR account.')
+            continue
+        if rule_id in rule_owners and rule_owners[rule_id][0] != key:
+            warnings.append(f'Row {line}: muting rule {rule_id} is also listed for {rule_owners[rule_id][1]}.')
+        rule_owners.setdefault(rule_id, (key, group_names[key]))
+        group_accounts.setdefault(key, {}).setdefault(nr_account, line)
+
+    # One NR account per client environment, and a blank ID disables every rule in its environment
+    for key, accounts in group_accounts.items():
+        if len(accounts) > 1:
+            errors.append(f'{group_names[key]} lists rules in more than one NR account: {sorted(accounts)}.')
+        if key in group_blanks:
+            errors.append(f'Row {group_blanks[key]}: {group_names[key]} mixes rows with and without muting rule IDs.')
+    return rows, errors, warnings
+
+
+def convert_rule_store(source, destination):
+    with open(source, 'rb') as source_file:
+        rows, errors, warnings = validate_rule_rows(read_rule_rows(source, source_file.read()))
+
+    for warning in warnings:
+        print(f'WARNING {warning}')
+    for error in errors:
+        print(f'ERROR {error}')
+    if errors:
+        print(f'{len(errors)} error(s) in {source}; {destination} was not written.')
+        return 1
+
+    with open(destination, 'w', newline='') as destination_file:
+        writer = csv.writer(destination_file)
+        writer.writerow(RULE_COLUMNS)
+        writer.writerows((client, envir, '' if rule_id is None else rule_id, '' if nr_account is None else nr_account)
+                         for client, envir, rule_id, nr_account in rows)
+    print(f'{len(rows)} muting rule row(s) written to {destination} with {len(warnings)} warning(s).')
+    return 0
+
+
+def get_stored_rule_data(logger, refresh=False, settings=DEFAULT_SETTINGS):
     logger.info('Fetching muting rule info...')
 
-    key = 'Muting Rules.xlsx'
+    key = settings.rules_key
 
-    muting_rules_file = s3.get_object(Bucket=BUCKET, Key=key)
-    muting_rules_data = muting_rules_file['Body'].read()
+    from botocore.exceptions import ClientError
 
-    columns = ['Client', 'Environment', 'Muting Rule ID', 'NR Account #']
-    muting_df = pd.read_excel(io.BytesIO(muting_rules_data), usecols=columns)
+    if refresh:
+        invalidate_rule_cache(logger, settings)
 
-    if not muting_df.empty:
-        logger.info('   Muting rule IDs loaded successfully.')
-        return muting_df
+    # Only download the spreadsheet when it has changed since the cached copy was parsed. Shards reading the same
+    # store share the parsed rules; the client special cases are their own.
+    request = {'Bucket': settings.bucket, 'Key': key}
+    cached = rule_cache.get((settings.bucket, key))
+    if cached:
+        request['IfNoneMatch'] = cached['etag']
+    try:
+        muting_rules_file = get_aws_client('s3').get_object(**request)
+    except ClientError as e:
+        if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304:
+            logger.info(f'   Muting rule cache hit (memory); {key} last modified {cached["last_modified"]}.')
+            return create_rule_index(cached['index'].rules, cached['index'].diagnostics, settings)
+        raise
+    etag = muting_rules_file['ETag']
+    last_modified = muting_rules_file.get('LastModified')
+
+    rule_index = read_rule_cache_file(etag, logger, settings)
+    if rule_index:
+        muting_rules_file['Body'].close()
+        logger.info(f'   Muting rule cache hit (disk); {key} last modified {last_modified}.')
     else:
-        logger.warning('   No muting rule data found.')
-        sys.exit(1)
+        logger.info(f'   Muting rule cache miss; parsing {key} last modified {last_modified}...')
+        muting_rules_data = muting_rules_file['Body'].read()
+        rule_rows = read_rule_rows(key, muting_rules_data)
 
+        if rule_rows:
+            logger.info('   Muting rule IDs loaded successfully.')
+            rule_index = build_rule_index(rule_rows, logger, settings)
+            write_rule_cache_file(etag, last_modified, rule_index, logger, settings)
+        else:
+            logger.warning('   No muting rule data found.')
+            sys.exit(1)
+
+    rule_cache[(settings.bucket, key)] = {'etag': etag, 'last_modified': last_modified, 'index': rule_index}
+    return rule_index
+
+
+def reset_aws_client(service):
+    global aws_session
+    with aws_clients_lock:
+        aws_clients.pop(service, None)
+        aws_session = None
+
+
+def get_api_keys(logger, refresh=False):
+    from botocore.exceptions import ClientError
 
-def get_api_key(api, logger):
     param_dict = {
         'monday': 'ae-muting-automation-monday-key',
         'new_relic': 'ae-muting-automation-new-relic-key'
     }
-    try:
-        response = ssm.get_parameter(Name=param_dict[api], WithDecryption=True)
-        key = response['Parameter']['Value']
-        logger.info(f'   {api} key retrieved successfully.')
-        return key
-    except exceptions.ClientError as e:
-        logger.warning(f'\nAPI key not retrieved from Parameter Store:\n{e}')
-        sys.exit(1)
 
+    # Worker threads share one cached copy instead of each calling Parameter Store
+    with api_key_lock:
+        if not refresh and api_key_cache and time.monotonic() < api_key_cache['expires']:
+            return api_key_cache['keys']
 
-def get_patching_events(logger):
-    logger.info('Fetching patching events...')
+        for attempt in range(2):
+            try:
+                with run_metrics.phase('ssm'):
+                    response = get_aws_client('ssm').get_parameters(Names=list(param_dict.values()),
+                                                                    WithDecryption=True)
+                break
+            except ClientError as e:
+                error_code = e.response.get('Error', {}).get('Code')
+                if attempt == 0 and error_code in ['UnrecognizedClientException', 'AccessDenied',
+                                                   'AccessDeniedException']:
+                    # Stale container credentials; rebuild the client once before giving up
+                    logger.warning(f'   Parameter Store returned {error_code}; refreshing client and cache...')
+                    api_key_cache.clear()
+                    reset_aws_client('ssm')
+                    continue
+                logger.warning(f'\nAPI key not retrieved from Parameter Store:\n{e}')
+                sys.exit(1)
+
+        if response['InvalidParameters']:
+            logger.warning(f'\nAPI key not retrieved from Parameter Store:\n{response["InvalidParameters"]}')
+            sys.exit(1)
+
+        values = {parameter['Name']: parameter['Value'] for parameter in response['Parameters']}
+        api_key_cache.update({
+            'keys': {api: values[name] for api, name in param_dict.items()},
+            'expires': time.monotonic() + API_KEY_TTL_SECONDS
+        })
+        logger.info('   API keys retrieved successfully.')
+        return api_key_cache['keys']
+
+
+def get_api_key(api, logger):
+    key = get_api_keys(logger)[api]
+    logger.info(f'   {api} key retrieved successfully.')
+    return key
+
+
+def get_monday_query_params(today, client_name=None, updated_since=None):
+    # Only events inside the look-back/look-ahead window come back from the board
+    rules = []
+    if client_name:
+        rules.append(f'{{column_id: "name", compare_value: [{json.dumps(client_name)}], operator: contains_text}}')
+    if updated_since:
+        # Monday compares update dates by day in the account's time zone, so the day before is included as well;
+        # callers narrow the items to the exact time with item_updated_after
+        rules.append(f'{{column_id: "__last_updated__", compare_value: ["EXACT", '
+                     f'"{updated_since - timedelta(days=1):%Y-%m-%d}"], operator: greater_than_or_equals, '
+                     f'compare_attribute: "UPDATED_AT"}}')
+    if MONDAY_LOOKBACK_DAYS:
+        rules.append(f'{{column_id: "date2", compare_value: ["EXACT", '
+                     f'"{today - timedelta(days=int(MONDAY_LOOKBACK_DAYS)):%Y-%m-%d}"], '
+                     f'operator: greater_than_or_equals}}')
+    if MONDAY_LOOKAHEAD_DAYS:
+        rules.append(f'{{column_id: "date2", compare_value: ["EXACT", '
+                     f'"{today + timedelta(days=int(MONDAY_LOOKAHEAD_DAYS)):%Y-%m-%d}"], '
+                     f'operator: lower_than_or_equal}}')
+    if MONDAY_EXCLUDED_STATUS_INDEXES:
+        rules.append(f'{{column_id: "status", compare_value: [{MONDAY_EXCLUDED_STATUS_INDEXES}], '
+                     f'operator: not_any_of}}')
+
+    if not rules:
+        return ''
+    return f', query_params: {{rules: [{", ".join(rules)}], operator: and}}'
 
+
+def get_monday_headers(logger):
     # Monday API call data
     api_token = get_api_key('monday', logger)
-    endpoint = 'https://api.monday.com/v2'
-    headers = {
+    return {
         'Authorization': api_token,
-        'Content-Type': 'application/json'
+        'Content-Type': 'application/json',
+        'API-Version': MONDAY_API_VERSION
+    }
+
+
+def get_patching_events(logger, client_name=None, settings=DEFAULT_SETTINGS, updated_since=None):
+    logger.info('Fetching patching events...')
+
+    headers = get_monday_headers(logger)
+
+    return stream_patching_events(MONDAY_ENDPOINT, headers, logger, client_name=client_name,
+                                  board_id=settings.board_id, updated_since=updated_since)
+
+
+def get_item_name(item_id, logger):
+    gql_query = Template("""
+    {
+      items (ids: [$item_id]) {
+        name
+      }
+    }
+    """).substitute({'item_id': int(item_id)})
+
+    with run_metrics.phase('monday_fetch'):
+        response = get_transport().request('POST', MONDAY_ENDPOINT, get_monday_headers(logger),
+                                           {'query': gql_query}, logger)
+    if 'errors' in response.keys() or not response['data']['items']:
+        logger.warning(f'Monday item {item_id} could not be fetched:\n{response}')
+        return None
+    return response['data']['items'][0]['name']
+
+
+def stream_patching_events(endpoint, headers, logger, client_name=None, board_id=MONDAY_BOARD_ID,
+                           updated_since=None):
+    # Monday board GraphQL queries to filter for specific columns, one page of items at a time
+    gql_first_page_template = Template("""
+    {
+      boards (ids: $board_id) {
+        items_page (limit: $limit$query_params) {
+          cursor
+          items {
+            name
+            id
+            updated_at
+            column_values (ids: [text, status, date2, numeric2]) {
+              id
+              text
+            }
+          }
+        }
+      }
     }
-    # Monday board GraphQL query to filter for specific columns
-    gql_query = """
+    """)
+    gql_next_page_template = Template("""
     {
-      boards (ids: 413857267) {
+      next_items_page (limit: $limit, cursor: "$cursor") {
+        cursor
         items {
           name
           id
+          updated_at
           column_values (ids: [text, status, date2, numeric2]) {
-            title
+            id
             text
           }
         }
       }
     }
-    """
+    """)
 
-    # Call the Monday API and transform the response into JSON format
-    response = requests.get(endpoint, headers=headers, json={'query': gql_query}).json()
-    logger.debug(f'Monday API response:\n{response}')
+    gql_query = gql_first_page_template.substitute({
+        'board_id': board_id,
+        'limit': MONDAY_PAGE_SIZE,
+        'query_params': get_monday_query_params(datetime.now(timezone.utc).date(), client_name, updated_since)
+    })
+    page_count = 0
+    item_count = 0
+    while gql_query:
+        with run_metrics.phase('monday_fetch'):
+            response = get_transport().request('POST', endpoint, headers, {'query': gql_query}, logger)
+
+        if 'errors' in response.keys():
+            logger.warning(f'There was an error calling the Monday API:\n{response}')
+            sys.exit(1)
+
+        if page_count == 0:
+            items_page = response['data']['boards'][0]['items_page']
+        else:
+            items_page = response['data']['next_items_page']
+        page_count += 1
+        item_count += len(items_page['items'])
+        logger.info(f'   Page {page_count} of patching events collected ({len(items_page["items"])} item(s)).')
+
+        yield from items_page['items']
+
+        cursor = items_page['cursor']
+        gql_query = gql_next_page_template.substitute({'limit': MONDAY_PAGE_SIZE, 'cursor': cursor}) if cursor else None
+
+    logger.info(f'   {item_count} patching event(s) collected successfully.')
+
+
+def normalize_key(value):
+    return ' '.join(str(value).split()).casefold()
 
-    if 'errors' in response.keys():
-        logger.warning(f'There was an error calling the Monday API:\n{response}')
-        sys.exit(1)
-    else:
-        monday_items = response['data']['boards'][0]['items']
-        logger.debug(f'Monday items:\n{monday_items}')
-        logger.info('   Patching events collected successfully.')
-        return monday_items
 
+def build_rule_index(rule_rows, logger, settings=DEFAULT_SETTINGS):
+    logger.info('   Building muting rule index...')
 
-def get_muting_rule_info(client, envir, df, logger):
+    grouped = {}
+    for client, envir, rule_id, nr_account in rule_rows:
+        grouped.setdefault((normalize_key(client), normalize_key(envir)), (client, envir, []))[2].append(
+            (rule_id, nr_account))
+
+    rules = {}
+    diagnostics = []
+    for key, (client, envir, rows) in grouped.items():
+        try:
+            rules[key] = (tuple(int(rule_id) for rule_id, _ in rows), int(rows[0][1]))
+        except (TypeError, ValueError):
+            # Keep the key so lookups can tell a missing rule apart from an unknown client
+            rules[key] = None
+            diagnostics.append(f'{client} {envir} does not have a muting rule in place.')
+
+    for diagnostic in diagnostics:
+        logger.warning(f'      {diagnostic}')
+    logger.info(f'   Indexed {len(rules)} client environment(s) with {len(diagnostics)} diagnostic(s).')
+
+    return create_rule_index(rules, diagnostics, settings)
+
+
+def create_rule_index(rules, diagnostics, settings=DEFAULT_SETTINGS):
+    return MutingRuleIndex(
+        rules=MappingProxyType(rules),
+        skip_clients=frozenset(normalize_key(client) for client in settings.clients_without_muting),
+        aliases=MappingProxyType({normalize_key(client): tuple((normalize_key(match), normalize_key(envir))
+                                                               for match, envir in aliases)
+                                  for client, aliases in settings.environment_aliases.items()}),
+        first_event_clients=frozenset(normalize_key(client) for client in settings.first_event_clients),
+        diagnostics=tuple(diagnostics)
+    )
+
+
+def get_muting_rule_info(client, envir, rule_index, logger):
     logger.info('   Extracting muting rule ID and New Relic account number...')
 
-    # Special handling for Lenovo patching event names
-    if client == 'Lenovo':
-        if 'Linux' in envir:
-            envir = 'Weekly Linux'
-        elif 'Windows' in envir:
-            envir = 'Weekly Windows'
+    client_key = normalize_key(client)
+    envir_key = normalize_key(envir)
+    # Environments such as Lenovo's weekly events share a single spreadsheet row
+    for match, alias in rule_index.aliases.get(client_key, ()):
+        if match in envir_key:
+            envir_key = alias
+            break
 
     try:
-        rule_df = df[(df['Client'] == client) & (df['Environment'] == envir)]
-        rule_ids = [int(value) for value in rule_df['Muting Rule ID']]
-        nr_account = df.loc[(df['Client'] == client) & (df['Environment'] == envir), 'NR Account #'].iloc[0]
-        logger.info(f'      Muting Rule ID(s): {rule_ids} in NR Account: {int(nr_account)}')
-        return rule_ids, int(nr_account)
-    except Exception as e:
-        error_type = e.__class__.__name__
-        if error_type == 'IndexError':
-            logger.warning(f'      {client} does not have muting rule information.')
-        elif error_type == 'ValueError':
-            logger.warning(f'      {client} {envir} does not have a muting rule in place.')
-        else:
-            logger.warning(f'      There was an error extracting muting rule information:\n'
-                           f'      {error_type}:\n{print_exc()}')
+        rule_info = rule_index.rules[(client_key, envir_key)]
+    except KeyError:
+        logger.warning(f'      {client} does not have muting rule information.')
+        return None, None
+    if rule_info is None:
+        logger.warning(f'      {client} {envir} does not have a muting rule in place.')
         return None, None
 
+    rule_ids, nr_account = rule_info
+    logger.info(f'      Muting Rule ID(s): {list(rule_ids)} in NR Account: {nr_account}')
+    return list(rule_ids), nr_account
 
-def transform_event_times(start, window, start_delta=None):
-    start_time_dt = datetime.strptime(start, '%Y-%m-%d %H:%M')
-    end_time_dt = datetime.strptime(start, '%Y-%m-%d %H:%M') + timedelta(hours=float(window))
 
-    if start_delta:
-        start_time_dt = start_time_dt + timedelta(hours=float(start_delta))
-        end_time_dt = end_time_dt + timedelta(hours=float(start_delta))
+def shard_owns_account(nr_account_num, settings=DEFAULT_SETTINGS):
+    if settings.accounts is not None and nr_account_num not in settings.accounts:
+        return False
+    if settings.account_group is not None:
+        group_index, group_count = settings.account_group
+        return nr_account_num % group_count == group_index
+    return True
 
-    start_time = datetime.strftime(start_time_dt, '%Y-%m-%dT%H:%M:%S')
-    end_time = datetime.strftime(end_time_dt, '%Y-%m-%dT%H:%M:%S')
-    return start_time, end_time
 
+def build_event_table(monday_items, logger):
+    import pandas as pd
 
-def check_nr_rules(monday_items, muting_df, logger):
-    logger.info('Processing patching events...')
-    rule_ids_not_mutated = []
-    events_not_processed = []
-    nr_response = None
-    lenovo_win_mod = False
-    lenovo_linux_mod = False
-
-    nbly_patching_windows = {
-        38495798: {
-            'description': 'Dev/QA ssm_patch_wave1',
-            'length': 1,
-            'delta': 0
-        },
-        38495968: {
-            'description': 'Dev/QA ssm_patch_wave1.5',
-            'length': 3,
-            'delta': 1
-        },
-        38496432: {
-            'description': 'Production ssm_patch_wave2',
-            'length': 1,
-            'delta': 0
-        },
-        38496605: {
-            'description': 'Production ssm_patch_wave2.5',
-            'length': 3,
-            'delta': 1
-        }
-    }
+    logger.info('Normalizing patching events...')
+    # Columns are matched by ID, since Monday returns them in the board's (reorderable) column order
+    column_ids = ['text', 'status', 'date2', 'numeric2']
+    rows = []
+    for item in monday_items:
+        columns = {column['id']: column['text'] for column in item['column_values']}
+        rows.append((item['name'], *(columns.get(column_id) for column_id in column_ids)))
+    events_df = pd.DataFrame(rows, columns=['client_name', 'environment', 'event_status', 'start_time',
+                                            'patching_window'])
 
-    try:
-        # NR API details
-        nr_api_key = get_api_key('new_relic', logger)
-        nr_endpoint = 'https://api.newrelic.com/graphql'
-        nr_headers = {
-            'Content-Type': 'application/json',
-            'API-Key': nr_api_key,
-        }
-        nr_gql_mutate_template = Template("""
-            mutation {
-              alertsMutingRuleUpdate(accountId: $account_id, id: $rule_id, rule: {enabled: $enabled, schedule: 
-                {startTime: "$start_time", endTime: "$end_time"}}) {
-                id
-              }
-            }
-            """)
-        nr_gql_query_template = Template("""
-                {
-                  actor {
-                    account(id: $account_id) {
+    # Every event window in one pass; unparseable dates or windows are flagged per row instead of raising
+    events_df['start'] = pd.to_datetime(events_df['start_time'], format='%Y-%m-%d %H:%M', errors='coerce')
+    events_df['window'] = pd.to_timedelta(pd.to_numeric(events_df['patching_window'], errors='coerce'), unit='h')
+    events_df['start_time_nr'] = events_df['start'].dt.strftime(NR_TIME_FORMAT)
+    events_df['end_time_nr'] = (events_df['start'] + events_df['window']).dt.strftime(NR_TIME_FORMAT)
+    events_df['valid'] = events_df['start'].notna() & events_df['window'].notna()
+
+    logger.info(f'   {len(events_df)} patching event(s) normalized; {(~events_df["valid"]).sum()} invalid.')
+    return events_df
+
+
+def get_rule_windows(events, events_df, logger, settings=DEFAULT_SETTINGS):
+    import pandas as pd
+
+    # Rules listed in the window table get their own length and start delta instead of the event's window
+    rules_df = pd.DataFrame([(event['index'], muting_rule_id)
+                             for event in events for muting_rule_id in event['muting_rule_ids']],
+                            columns=['index', 'rule_id'])
+    if rules_df.empty:
+        return
+    windows_df = pd.read_csv(settings.rule_windows_path).rename(
+        columns={'Muting Rule ID': 'rule_id', 'Length': 'length', 'Delta': 'delta'})
+    rules_df = rules_df.merge(windows_df[['rule_id', 'length', 'delta']], on='rule_id', how='left') \
+        .join(events_df[['start', 'window']], on='index')
+    logger.debug(f'{rules_df["length"].notna().sum()} muting rule window override(s) applied.')
+
+    start = rules_df['start'] + pd.to_timedelta(rules_df['delta'].fillna(0), unit='h')
+    end = start + pd.to_timedelta(rules_df['length'], unit='h').fillna(rules_df['window'])
+    rules_df['start_time_nr'] = start.dt.strftime(NR_TIME_FORMAT)
+    rules_df['end_time_nr'] = end.dt.strftime(NR_TIME_FORMAT)
+
+    rule_windows = {}
+    for i, muting_rule_id, start_time_nr, end_time_nr in rules_df[['index', 'rule_id', 'start_time_nr',
+                                                                   'end_time_nr']].itertuples(index=False):
+        rule_windows.setdefault(i, {})[muting_rule_id] = (start_time_nr, end_time_nr)
+    for event in events:
+        event['rule_windows'] = rule_windows[event['index']]
+
+
+def get_nr_muting_rule_chunk(chunk, nr_endpoint, nr_headers, rate_limiter, logger):
+    # One aliased mutingRule read per rule, all against the same account
+    nr_gql_alias_template = Template("""
+                    r$index: account(id: $account_id) {
                       alerts {
                         mutingRule(id: $rule_id) {
                           id
@@ -201,207 +898,750 @@ def check_nr_rules(monday_items, muting_df, logger):
                           }
                         }
                       }
-                    }
-                  }
-                }
-            """)
-        nr_gql_enable_template = Template("""
-            mutation {
-                alertsMutingRuleUpdate(accountId: $account_id, id: $rule_id, rule: 
-                  {enabled: $enabled}) {
-                  id
-              }
-            }
-            """)
-
-        for i in range(len(monday_items)):
-            event_status = monday_items[i]['column_values'][1]['text']
-            client_name = monday_items[i]['name']
-            environment = monday_items[i]['column_values'][0]['text']
-            patching_window = monday_items[i]['column_values'][3]['text']
-            start_time = monday_items[i]['column_values'][2]['text']
-
-            clients_without_muting = ['Ollion Infra', 'Gas Station TV', 'Michael Kors', 'NAIC', 'Symetra', 'TitleMax',
-                                      'Rayonier AM', 'test']
-
-            if client_name in clients_without_muting:
-                logger.info(f'\n   Event {i + 1}: {client_name} does not have muting rules in place; skipping event.')
-                continue
-            # If the first instance of an upcoming Lenovo event has already been mutated, skip any other events
-            elif (client_name == 'Lenovo' and lenovo_win_mod) or (client_name == 'Lenovo' and lenovo_linux_mod):
-                logger.info(f'\n   Event {i + 1}: More recent Lenovo event is scheduled; skipping event.')
-                continue
-            else:
-                # print(f"Patching window for {client_name}: {patching_window}; data type: {type(patching_window)}")
-                start_time_nr, end_time_nr = transform_event_times(start_time, patching_window)
-
-                logger.info(f'\n   Event {i + 1}: {event_status} for {client_name} {environment} at {start_time_nr} '
-                            f'for {patching_window} hours, ending at {end_time_nr}.')
-
-                # Muting rule ID and account corresponding to patching event data
-                muting_rule_ids, nr_account_num = get_muting_rule_info(client_name, environment, muting_df, logger)
-                if not muting_rule_ids:
+                    }""")
+
+    aliases = {f'r{index}': rule_key for index, rule_key in enumerate(chunk)}
+    nr_gql_query_fmtd = '{\n  actor {' + ''.join(
+        nr_gql_alias_template.substitute({'index': index, 'account_id': account_id, 'rule_id': rule_id})
+        for index, (account_id, rule_id) in enumerate(chunk)) + '\n  }\n}'
+
+    nr_response = post_nr_query(nr_gql_query_fmtd, chunk[0][0], nr_endpoint, nr_headers, rate_limiter, logger)
+
+    nr_rules = {}
+    nr_errors = {}
+    # Map partial errors back to their rule through the alias in the error path
+    for error in nr_response.get('errors') or []:
+        path = error.get('path') or []
+        if len(path) > 1 and path[1] in aliases:
+            nr_errors[aliases[path[1]]] = error.get('message')
+        else:
+            for rule_key in chunk:
+                nr_errors.setdefault(rule_key, error.get('message'))
+
+    actor = (nr_response.get('data') or {}).get('actor') or {}
+    for alias, rule_key in aliases.items():
+        try:
+            event_rule = actor[alias]['alerts']['mutingRule']
+        except (KeyError, TypeError):
+            event_rule = None
+        if event_rule:
+            nr_rules[rule_key] = event_rule
+        else:
+            nr_errors.setdefault(rule_key, f'Muting rule {rule_key[1]} was not returned by New Relic.')
+
+    return nr_rules, nr_errors
+
+
+def get_nr_muting_rules(rule_keys, nr_endpoint, nr_headers, logger, max_workers=NR_MAX_WORKERS,
+                        chunk_size=NR_QUERY_CHUNK_SIZE):
+    # Group the rules by account into aliased queries of up to chunk_size reads, so the per-account rate limit
+    # applies to reads as it does to writes
+    account_keys = {}
+    for rule_key in rule_keys:
+        account_keys.setdefault(rule_key[0], []).append(rule_key)
+    chunks = [account_chunk[chunk_start:chunk_start + chunk_size]
+              for account_chunk in account_keys.values()
+              for chunk_start in range(0, len(account_chunk), chunk_size)]
+    logger.info(f'Querying {len(rule_keys)} muting rule(s) in {len(chunks)} batch(es) with {max_workers} '
+                f'worker(s)...')
+    rate_limiter = AccountRateLimiter(NR_ACCOUNT_REQUESTS_PER_SECOND)
+
+    if max_workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda chunk: get_nr_muting_rule_chunk(chunk, nr_endpoint, nr_headers, rate_limiter, logger), chunks))
+    else:
+        results = [get_nr_muting_rule_chunk(chunk, nr_endpoint, nr_headers, rate_limiter, logger) for chunk in chunks]
+
+    nr_rules = {}
+    nr_errors = {}
+    for chunk_rules, chunk_errors in results:
+        nr_rules.update(chunk_rules)
+        nr_errors.update(chunk_errors)
+    return nr_rules, nr_errors
+
+
+class AccountRateLimiter:
+    """Spaces out NerdGraph requests made against the same New Relic account across worker threads."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.lock = threading.Lock()
+        self.next_request = {}
+
+    def wait(self, account_id):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            scheduled = max(now, self.next_request.get(account_id, now))
+            self.next_request[account_id] = scheduled + self.interval
+        time.sleep(max(0.0, scheduled - now))
+
+
+def post_nr_query(nr_query, account_id, nr_endpoint, nr_headers, rate_limiter, logger):
+    rate_limiter.wait(account_id)
+    nr_response = get_transport().request('POST', nr_endpoint, nr_headers, {'query': nr_query}, logger)
+    log_api_response(logger, 'New Relic', nr_response)
+    return nr_response
+
+
+def get_rule_state(event_rule):
+    # handle muting rules without a start or end time already in place
+    try:
+        event_start = event_rule['schedule']['startTime']
+        event_end = event_rule['schedule']['endTime']
+    except TypeError:
+        event_start = '2023-01-01T00:00:00-06:00'
+        event_end = '2023-01-01T01:00:00-06:00'
+    return {'enabled': event_rule['enabled'], 'start_time': event_start[:19], 'end_time': event_end[:19]}
+
+
+def plan_rule_changes(events, nr_rules, nr_errors, logger):
+    logger.info('Planning muting rule changes...')
+    rules_not_mutated = []
+    events_not_processed = []
+    first_event_applied = set()
+
+    # Desired state of every rule an event wants to change, resolved in board order so later events win
+    desired_states = {}
+    rule_events = {}
+
+    for event in events:
+        i = event['index']
+        event_status = event['event_status']
+        client_name = event['client_name']
+        environment = event['environment']
+        muting_rule_ids = event['muting_rule_ids']
+        nr_account_num = event['nr_account_num']
+
+        # If the first instance of an upcoming event for a client such as Lenovo is already being mutated, skip
+        # any other events
+        if event['first_event'] is not None and normalize_key(client_name) in first_event_applied:
+            logger.info(f'\n   Event {i + 1}: More recent {client_name} event is scheduled; skipping event.')
+            continue
+
+        logger.info(f'\n   Event {i + 1}: {event_status} for {client_name} {environment}.')
+
+        if event_status in ACTIVE_STATUSES:
+            # Check rule for start and end time and enabled;
+            # if needed, plan to mutate if times are incorrect and enable rule
+            for muting_rule_id in muting_rule_ids:
+
+                # Event window, or the rule's own window for rules such as Neighborly's patch waves
+                start_time_nr, end_time_nr = event['rule_windows'][muting_rule_id]
+
+                rule_key = (nr_account_num, muting_rule_id)
+                if rule_key not in nr_rules:
+                    logger.warning(f'      There was an error querying the muting role:\n{nr_errors.get(rule_key)}')
+                    rules_not_mutated.append((i, muting_rule_id))
                     continue
+                rule_state = desired_states.get(rule_key) or get_rule_state(nr_rules[rule_key])
 
-                if event_status in ['Event Prep In Progress', 'To-Do', 'Event Scheduled']:
-                    # Check rule for start and end time and enabled;
-                    # if needed, mutate if times are incorrect and enable rule
-                    for muting_rule_id in muting_rule_ids:
-
-                        # Special time handling for Neighborly event times
-                        if client_name == 'Neighborly':
-                            try:
-                                nbly_patching_window = nbly_patching_windows[muting_rule_id]['length']
-                                start_delta = nbly_patching_windows[muting_rule_id]['delta']
-                                start_time_nr, end_time_nr = transform_event_times(start_time,
-                                                                                   nbly_patching_window,
-                                                                                   start_delta=start_delta)
-                            except KeyError:
-                                logger.debug('Neighborly Spillover event. No timedelta needed.')
-
-                        nr_gql_query_fmtd = nr_gql_query_template.substitute({'account_id': nr_account_num,
-                                                                              'rule_id': muting_rule_id})
-                        try:
-                            nr_response = requests.post(nr_endpoint,
-                                                        headers=nr_headers,
-                                                        json={'query': nr_gql_query_fmtd}).json()
-                            logger.debug(f'New Relic API response:\n{nr_response}')
-
-                            event_rule = nr_response['data']['actor']['account']['alerts']['mutingRule']
-                            enabled = event_rule['enabled']
-                            # handle muting rules without a start or end time already in place
-                            try:
-                                event_start = event_rule['schedule']['startTime']
-                                event_end = event_rule['schedule']['endTime']
-                            except TypeError:
-                                event_start = '2023-01-01T00:00:00-06:00'
-                                event_end = '2023-01-01T01:00:00-06:00'
-
-                            # If rule start time and end time match Monday event data, skip mutation
-                            if start_time_nr == event_start[:19] and end_time_nr == event_end[:19] and enabled:
-                                logger.info(
-                                    f'   Muting rule {muting_rule_id} times match Monday event; no action taken.')
-                                continue
-                            elif start_time_nr == event_start[:19] and end_time_nr == event_end[:19] and not enabled:
-                                logger.info(f'   Muting rule {muting_rule_id} times match Monday event but rule is '
-                                            f'disabled; enabling rule...')
-
-                                nr_gql_enable_fmtd = nr_gql_enable_template.substitute(
-                                    {'account_id': nr_account_num,
-                                     'rule_id': muting_rule_id,
-                                     'enabled': 'true'})
-                                nr_response = requests.post(nr_endpoint,
-                                                            headers=nr_headers,
-                                                            json={'query': nr_gql_enable_fmtd}).json()
-                                logger.debug(f'New Relic API response:\n{nr_response}')
-
-                                try:
-                                    if nr_response['data']['alertsMutingRuleUpdate']['id'] == str(muting_rule_id):
-                                        # Sepcial handling for weekly repeating Lenovo patching events
-                                        if client_name == 'Lenovo':
-                                            if 'Windows' in environment:
-                                                lenovo_win_mod = True
-                                            elif 'Linux' in environment:
-                                                lenovo_linux_mod = True
-                                        logger.info(f'      Muting rule ID {muting_rule_id} was successfully enabled.')
-                                except KeyError:
-                                    logger.warning(f'      There was an error enabling the muting role:\n'
-                                                   f'{nr_response}')
-                                    rule_ids_not_mutated.append(f'Event {i + 1}: {muting_rule_id}')
-                                continue
-                            else:
-                                logger.info(f'   Mutating muting rule {muting_rule_id} for {client_name}...')
-                                logger.debug(f'Start time to be entered: {start_time_nr}')
-                                logger.debug(f'End time to be entered: {end_time_nr}')
-
-                                nr_gql_mutate_fmtd = nr_gql_mutate_template.substitute({'account_id': nr_account_num,
-                                                                                        'start_time': start_time_nr,
-                                                                                        'end_time': end_time_nr,
-                                                                                        'rule_id': muting_rule_id,
-                                                                                        'enabled': 'true'})
-                                nr_response = requests.post(nr_endpoint,
-                                                            headers=nr_headers,
-                                                            json={'query': nr_gql_mutate_fmtd}).json()
-                                logger.debug(f'New Relic API response:\n{nr_response}')
-
-                                try:
-                                    if nr_response['data']['alertsMutingRuleUpdate']['id'] == str(muting_rule_id):
-                                        # Sepcial handling for weekly repeating Lenovo patching events
-                                        if client_name == 'Lenovo':
-                                            if 'Windows' in environment:
-                                                lenovo_win_mod = True
-                                            elif 'Linux' in environment:
-                                                lenovo_linux_mod = True
-                                        logger.info(f'      Muting rule ID {muting_rule_id} was successfully modified.')
-                                except KeyError:
-                                    logger.warning(f'      There was an error mutating the muting role:\n{nr_response}')
-                                    rule_ids_not_mutated.append(f'Event {i + 1}: {muting_rule_id}')
-                                    continue
-                        except KeyError:
-                            logger.warning(f'      There was an error querying the muting role:\n{nr_response}')
-                            rule_ids_not_mutated.append(f'Event {i + 1}: {muting_rule_id}')
-                            continue
-                elif event_status in ['Event Complete', 'Paused/On-Hold', 'All Compliant', 'Event Failed',
-                                      'Event Cancelled', 'Engineering Team Assigned', 'Event to be Rescheduled',
-                                      'Awaiting Approval/Review']:
-                    logger.info(f'   Checking enabled/disabled muting rule status for this event...')
-
-                    for muting_rule_id in muting_rule_ids:
-                        # Query rule to check if it is enabled or disabled
-                        nr_gql_query_fmtd = nr_gql_query_template.substitute({'account_id': nr_account_num,
-                                                                              'rule_id': muting_rule_id})
-                        nr_response = requests.post(nr_endpoint,
-                                                    headers=nr_headers,
-                                                    json={'query': nr_gql_query_fmtd}).json()
-                        logger.debug(f'New Relic API response:\n{nr_response}')
-
-                        try:
-                            # If the 'errors' key exists in the API response, log the error
-                            logger.warning(f'      NR error for {muting_rule_id}: '
-                                           f'{nr_response["errors"][0]["message"]}')
-                            rule_ids_not_mutated.append(f'Event {i + 1}: {muting_rule_id}')
-                        except KeyError:
-                            # If the 'errors' key does not exist in the API response, disable the rule if necessary
-                            if not nr_response['data']['actor']['account']['alerts']['mutingRule']['enabled']:
-                                logger.info(f'      Muting rule {muting_rule_id} is already disabled; no action taken.')
-                                continue
-                            else:
-                                nr_gql_disable_fmtd = nr_gql_enable_template.substitute(
-                                    {'account_id': nr_account_num,
-                                     'rule_id': muting_rule_id,
-                                     'enabled': 'false'})
-                                nr_response = requests.post(nr_endpoint,
-                                                            headers=nr_headers,
-                                                            json={'query': nr_gql_disable_fmtd}).json()
-                                logger.debug(f'New Relic API response:\n{nr_response}')
-
-                                if nr_response['data']['alertsMutingRuleUpdate']['id'] == str(muting_rule_id):
-                                    logger.info(f'      Muting rule ID {muting_rule_id} was successfully disabled.')
-                                else:
-                                    logger.warning(f'      There was an error disabling the muting role:\n'
-                                                   f'{nr_response}')
-                                    rule_ids_not_mutated.append(f'Event {i + 1}: {muting_rule_id}')
-                                    continue
-                elif event_status == 'Event In Progress':
-                    logger.info(f'Event {i + 1} for {client_name} {environment} is in progress; no action taken.')
-                    events_not_processed.append(f'Event {i + 1}: {event_status} --> {client_name} {environment}')
+                # If rule start time and end time match Monday event data, skip mutation
+                if start_time_nr == rule_state['start_time'] and end_time_nr == rule_state['end_time'] and \
+                        rule_state['enabled']:
+                    logger.info(f'   Muting rule {muting_rule_id} times match Monday event; no action taken.')
                     continue
+                elif start_time_nr == rule_state['start_time'] and end_time_nr == rule_state['end_time']:
+                    logger.info(f'   Muting rule {muting_rule_id} times match Monday event but rule is '
+                                f'disabled; planning to enable rule.')
                 else:
-                    logger.warning(f'   Status "{event_status}" is a mismatch for event {i + 1}. Skipping event.')
-                    events_not_processed.append(f'Event {i + 1}: {event_status} --> {client_name} {environment}')
+                    logger.info(f'   Planning to mutate muting rule {muting_rule_id} for {client_name} from '
+                                f'{start_time_nr} to {end_time_nr}.')
+
+                desired_states[rule_key] = {'enabled': True, 'start_time': start_time_nr, 'end_time': end_time_nr}
+                rule_events.setdefault(rule_key, []).append(i)
+                # Sepcial handling for weekly repeating patching events such as Lenovo's
+                if event['first_event']:
+                    first_event_applied.add(normalize_key(client_name))
+        elif event_status in INACTIVE_STATUSES:
+            logger.info(f'   Checking enabled/disabled muting rule status for this event...')
+
+            for muting_rule_id in muting_rule_ids:
+                rule_key = (nr_account_num, muting_rule_id)
+                if rule_key not in nr_rules:
+                    # If the rule could not be read, log the error
+                    logger.warning(f'      NR error for {muting_rule_id}: {nr_errors.get(rule_key)}')
+                    rules_not_mutated.append((i, muting_rule_id))
                     continue
-        return 0, rule_ids_not_mutated, events_not_processed
+                rule_state = desired_states.get(rule_key) or get_rule_state(nr_rules[rule_key])
+
+                if not rule_state['enabled']:
+                    logger.info(f'      Muting rule {muting_rule_id} is already disabled; no action taken.')
+                    continue
+                logger.info(f'      Planning to disable muting rule {muting_rule_id}.')
+                desired_states[rule_key] = dict(rule_state, enabled=False)
+                rule_events.setdefault(rule_key, []).append(i)
+        elif event_status == 'Event In Progress':
+            logger.info(f'Event {i + 1} for {client_name} {environment} is in progress; no action taken.')
+            events_not_processed.append((i, f'{event_status} --> {client_name} {environment}'))
+        else:
+            logger.warning(f'   Status "{event_status}" is a mismatch for event {i + 1}. Skipping event.')
+            events_not_processed.append((i, f'{event_status} --> {client_name} {environment}'))
+
+    # Fold every event's update into one change per rule and drop the ones that end where they started
+    changes = []
+    for (nr_account_num, muting_rule_id), desired_state in desired_states.items():
+        current_state = get_rule_state(nr_rules[(nr_account_num, muting_rule_id)])
+        if desired_state == current_state:
+            continue
+        schedule_changed = (desired_state['start_time'], desired_state['end_time']) != \
+                           (current_state['start_time'], current_state['end_time'])
+        changes.append({
+            'account_id': nr_account_num,
+            'rule_id': muting_rule_id,
+            'enabled': desired_state['enabled'],
+            'schedule': {'startTime': desired_state['start_time'],
+                         'endTime': desired_state['end_time']} if schedule_changed else None,
+            'current': current_state,
+            'events': [i + 1 for i in rule_events[(nr_account_num, muting_rule_id)]]
+        })
+    logger.info(f'\n{len(changes)} muting rule change(s) planned.')
+
+    return changes, rules_not_mutated, events_not_processed
+
+
+def format_rule_update(change, alias=''):
+    nr_gql_mutate_template = Template("""
+          $alias alertsMutingRuleUpdate(accountId: $account_id, id: $rule_id, rule: {enabled: $enabled, schedule: 
+            {startTime: "$start_time", endTime: "$end_time"}}) {
+            id
+          }""")
+    nr_gql_enable_template = Template("""
+          $alias alertsMutingRuleUpdate(accountId: $account_id, id: $rule_id, rule: 
+            {enabled: $enabled}) {
+            id
+          }""")
+
+    enabled = 'true' if change['enabled'] else 'false'
+    if change['schedule']:
+        return nr_gql_mutate_template.substitute({'alias': alias,
+                                                  'account_id': change['account_id'],
+                                                  'start_time': change['schedule']['startTime'],
+                                                  'end_time': change['schedule']['endTime'],
+                                                  'rule_id': change['rule_id'],
+                                                  'enabled': enabled})
+    return nr_gql_enable_template.substitute({'alias': alias,
+                                              'account_id': change['account_id'],
+                                              'rule_id': change['rule_id'],
+                                              'enabled': enabled})
+
+
+def apply_rule_change_batch(changes, nr_endpoint, nr_headers, rate_limiter, logger):
+    # One aliased alertsMutingRuleUpdate per change, all against the same account
+    aliases = {f'm{index}': change for index, change in enumerate(changes)}
+    nr_gql_fmtd = 'mutation {' + ''.join(format_rule_update(change, f'{alias}:')
+                                         for alias, change in aliases.items()) + '\n}'
+    # A request that still fails after the transport's retries, or returns a body that is not JSON, fails the whole
+    # batch instead of the run, so the other batches and the snapshot are kept. Its changes are not retried one by
+    # one, since each retry would sit through the same retries and timeouts again.
+    try:
+        nr_response = post_nr_query(nr_gql_fmtd, changes[0]['account_id'], nr_endpoint, nr_headers, rate_limiter,
+                                    logger)
+    except (*get_transport().retry_exceptions, ValueError) as e:
+        logger.warning(f'      Batch of {len(changes)} muting rule update(s) in account {changes[0]["account_id"]} '
+                       f'failed:\n{e.__class__.__name__}: {e}')
+        return list(changes)
+
+    data = nr_response.get('data') or {}
+    failed = []
+    for alias, change in aliases.items():
+        if (data.get(alias) or {}).get('id') == str(change['rule_id']):
+            logger.info(f'      Muting rule ID {change["rule_id"]} was successfully '
+                        f'{"modified" if change["schedule"] else "enabled" if change["enabled"] else "disabled"}.')
+        else:
+            failed.append(change)
+
+    # Retry only the aliases that failed, one request each, so errors are reported per rule
+    if failed and len(changes) > 1:
+        logger.warning(f'      {len(failed)} of {len(changes)} batched muting rule update(s) failed in account '
+                       f'{changes[0]["account_id"]}; retrying individually...')
+        failed = [change for change in failed
+                  if apply_rule_change_batch([change], nr_endpoint, nr_headers, rate_limiter, logger)]
+    elif failed:
+        logger.warning(f'      There was an error updating muting rule {changes[0]["rule_id"]}:\n{nr_response}')
+
+    return failed
+
+
+def apply_rule_changes(changes, nr_endpoint, nr_headers, logger, max_workers=NR_MAX_WORKERS,
+                       chunk_size=NR_MUTATION_CHUNK_SIZE):
+    # Group the changes by account into aliased mutation documents of up to chunk_size updates
+    account_changes = {}
+    for change in changes:
+        account_changes.setdefault(change['account_id'], []).append(change)
+    batches = [account_batch[chunk_start:chunk_start + chunk_size]
+               for account_batch in account_changes.values()
+               for chunk_start in range(0, len(account_batch), chunk_size)]
+    logger.info(f'Applying {len(changes)} muting rule change(s) in {len(batches)} batch(es) with {max_workers} '
+                f'worker(s)...')
+    rate_limiter = AccountRateLimiter(NR_ACCOUNT_REQUESTS_PER_SECOND)
+
+    if max_workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda batch: apply_rule_change_batch(batch, nr_endpoint, nr_headers, rate_limiter, logger), batches))
+    else:
+        results = [apply_rule_change_batch(batch, nr_endpoint, nr_headers, rate_limiter, logger) for batch in batches]
+
+    return [change for failed in results for change in failed]
+
+
+def get_rule_fingerprints(events):
+    # Everything about the Monday events that decides a rule's desired state, in board order
+    event_keys = {}
+    first_event_sources = {}
+    rule_first_event_clients = {}
+    for event in events:
+        if event['event_status'] not in ACTIVE_STATUSES + INACTIVE_STATUSES:
+            continue
+        event_source = [event['event_status'], event['client_name'], event['environment'],
+                        sorted(event['rule_windows'].items())]
+        client_key = normalize_key(event['client_name'])
+        if event['first_event'] is not None:
+            first_event_sources.setdefault(client_key, []).append(event_source)
+        for muting_rule_id in event['muting_rule_ids']:
+            rule_key = (event['nr_account_num'], muting_rule_id)
+            event_keys.setdefault(rule_key, []).append(event_source)
+            if event['first_event'] is not None:
+                rule_first_event_clients[rule_key] = client_key
+
+    fingerprints = {}
+    for rule_key, event_sources in event_keys.items():
+        # Any event of a first-event client can decide which one is applied to every rule of that client
+        if rule_key in rule_first_event_clients:
+            event_sources = first_event_sources[rule_first_event_clients[rule_key]]
+        fingerprints[rule_key] = hashlib.sha1(json.dumps(event_sources).encode()).hexdigest()
+    return fingerprints
+
+
+def load_rule_snapshot(logger, settings=DEFAULT_SETTINGS):
+    from botocore.exceptions import ClientError
+
+    try:
+        if SNAPSHOT_STORE == 's3':
+            snapshot_file = get_aws_client('s3').get_object(Bucket=settings.bucket, Key=settings.snapshot_key)
+            snapshot = json.loads(snapshot_file['Body'].read())
+        elif SNAPSHOT_STORE == 'tmp':
+            with open(settings.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        else:
+            return None
+    except (ClientError, OSError, ValueError) as e:
+        logger.info(f'   No usable muting rule snapshot found ({e.__class__.__name__}); verifying every rule.')
+        return None
+
+    snapshot['rules'] = {(nr_account_num, muting_rule_id): (fingerprint, {'enabled': enabled, 'start_time': start,
+                                                                          'end_time': end})
+                         for nr_account_num, muting_rule_id, fingerprint, enabled, start, end in snapshot['rules']}
+    return snapshot
+
+
+def save_rule_snapshot(rule_states, fingerprints, verified_at, logger, settings=DEFAULT_SETTINGS):
+    snapshot = {
+        'verified_at': verified_at,
+        'rules': [[nr_account_num, muting_rule_id, fingerprints[(nr_account_num, muting_rule_id)],
+                   rule_state['enabled'], rule_state['start_time'], rule_state['end_time']]
+                  for (nr_account_num, muting_rule_id), rule_state in rule_states.items()]
+    }
+    snapshot_data = json.dumps(snapshot, separators=(',', ':'))
+    try:
+        if SNAPSHOT_STORE == 's3':
+            get_aws_client('s3').put_object(Bucket=settings.bucket, Key=settings.snapshot_key,
+                                            Body=snapshot_data.encode(), ContentType='application/json')
+        elif SNAPSHOT_STORE == 'tmp':
+            with open(f'{settings.snapshot_path}.tmp', 'w') as snapshot_file:
+                snapshot_file.write(snapshot_data)
+            os.replace(f'{settings.snapshot_path}.tmp', settings.snapshot_path)
+        else:
+            return
+        logger.info(f'   Muting rule snapshot saved with {len(rule_states)} rule(s).')
+    except Exception as e:
+        logger.warning(f'   Muting rule snapshot could not be saved: {e.__class__.__name__}: {e}')
+
+
+def resolve_events(events_df, rule_index, logger, settings=DEFAULT_SETTINGS):
+    # Resolve every event to its muting rules first so the rules can be read in batched queries
+    events = []
+    rule_keys = []
+    invalid_events = []
+    for i, client_name, environment, event_status, start_time, patching_window, start_time_nr, end_time_nr, \
+            valid in events_df[['client_name', 'environment', 'event_status', 'start_time', 'patching_window',
+                                'start_time_nr', 'end_time_nr', 'valid']].itertuples(name=None):
+        if normalize_key(client_name) in rule_index.skip_clients:
+            logger.info(f'\n   Event {i + 1}: {client_name} does not have muting rules in place; skipping event.')
+            continue
+
+        if not valid:
+            logger.warning(f'\n   Event {i + 1}: {client_name} {environment} has an invalid start "{start_time}" '
+                           f'or window "{patching_window}"; skipping event.')
+            invalid_events.append((i, f'Invalid start or window --> {client_name} {environment}'))
+            continue
+
+        logger.info(f'\n   Event {i + 1}: {event_status} for {client_name} {environment} at {start_time_nr} '
+                    f'for {patching_window} hours, ending at {end_time_nr}.')
+
+        # Muting rule ID and account corresponding to patching event data
+        muting_rule_ids, nr_account_num = get_muting_rule_info(client_name, environment, rule_index, logger)
+        if not muting_rule_ids:
+            continue
+        if not shard_owns_account(nr_account_num, settings):
+            logger.info(f'      NR Account {nr_account_num} belongs to another shard; skipping event.')
+            continue
+
+        # For first-event clients, an event in one of the client's aliased environments (e.g. Lenovo's Linux and
+        # Windows groups) that changes a rule keeps the client's later events from being applied
+        client_key = normalize_key(client_name)
+        first_event = None
+        if client_key in rule_index.first_event_clients:
+            first_event = any(match in normalize_key(environment)
+                              for match, _ in rule_index.aliases.get(client_key, ())) or \
+                client_key not in rule_index.aliases
+
+        events.append({
+            'index': i,
+            'event_status': event_status,
+            'client_name': client_name,
+            'environment': environment,
+            'muting_rule_ids': muting_rule_ids,
+            'nr_account_num': nr_account_num,
+            'first_event': first_event
+        })
+        if event_status in ACTIVE_STATUSES + INACTIVE_STATUSES:
+            rule_keys.extend((nr_account_num, muting_rule_id) for muting_rule_id in muting_rule_ids)
+
+    return events, rule_keys, invalid_events
+
+
+def check_nr_rules(monday_items, rule_index, logger, max_workers=NR_MAX_WORKERS, dry_run=False,
+                   full_verify=False, use_snapshot=True, settings=DEFAULT_SETTINGS):
+    logger.info('Processing patching events...')
+
+    try:
+        # NR API details
+        nr_api_key = get_api_key('new_relic', logger)
+        nr_endpoint = NR_ENDPOINT
+        nr_headers = {
+            'Content-Type': 'application/json',
+            'API-Key': nr_api_key,
+        }
+
+        with run_metrics.phase('matching'):
+            events_df = build_event_table(monday_items, logger)
+            events, rule_keys, invalid_events = resolve_events(events_df, rule_index, logger, settings)
+            get_rule_windows(events, events_df, logger, settings)
+            fingerprints = get_rule_fingerprints(events)
+
+        # Rules whose Monday events are unchanged since the last run are taken from the snapshot instead of New
+        # Relic, except on the periodic full verify that catches manual edits
+        with run_metrics.phase('snapshot'):
+            snapshot = load_rule_snapshot(logger, settings) if use_snapshot else None
+        now = datetime.now(timezone.utc)
+        if snapshot and not full_verify and \
+                now - datetime.fromisoformat(snapshot['verified_at']) < timedelta(hours=SNAPSHOT_VERIFY_HOURS):
+            verified_at = snapshot['verified_at']
+            snapshot_states = {rule_key: rule_state
+                               for rule_key, (fingerprint, rule_state) in snapshot['rules'].items()
+                               if fingerprints.get(rule_key) == fingerprint}
+        else:
+            logger.info('   Verifying every muting rule against New Relic.')
+            verified_at = now.isoformat()
+            snapshot_states = {}
+        logger.info(f'   {len(snapshot_states)} of {len(fingerprints)} muting rule(s) unchanged since the last run.')
+
+        with run_metrics.phase('nr_reads'):
+            nr_rules, nr_errors = get_nr_muting_rules([rule_key for rule_key in dict.fromkeys(rule_keys)
+                                                       if rule_key not in snapshot_states],
+                                                      nr_endpoint, nr_headers, logger, max_workers)
+        for (nr_account_num, muting_rule_id), rule_state in snapshot_states.items():
+            nr_rules[(nr_account_num, muting_rule_id)] = {
+                'id': str(muting_rule_id),
+                'enabled': rule_state['enabled'],
+                'schedule': {'startTime': rule_state['start_time'], 'endTime': rule_state['end_time']}
+            }
+
+        with run_metrics.phase('planning'):
+            changes, rules_not_mutated, events_skipped = plan_rule_changes(events, nr_rules, nr_errors, logger)
+        if dry_run:
+            logger.info(f'Dry run; skipping writes. Planned changes:\n{json.dumps(changes)}')
+        else:
+            with run_metrics.phase('nr_writes'):
+                failed_changes = apply_rule_changes(changes, nr_endpoint, nr_headers, logger, max_workers)
+            # Report a failed change against every event that asked for it
+            rules_not_mutated += [(event_number - 1, change['rule_id'])
+                                  for change in failed_changes for event_number in change['events']]
+
+            # Record the state every rule was left in; failed rules are left out so the next run reads them again
+            rule_states = {rule_key: get_rule_state(event_rule) for rule_key, event_rule in nr_rules.items()}
+            for change in changes:
+                rule_state = rule_states[(change['account_id'], change['rule_id'])]
+                rule_state['enabled'] = change['enabled']
+                if change['schedule']:
+                    rule_state['start_time'] = change['schedule']['startTime']
+                    rule_state['end_time'] = change['schedule']['endTime']
+            for change in failed_changes:
+                del rule_states[(change['account_id'], change['rule_id'])]
+            if use_snapshot:
+                with run_metrics.phase('snapshot'):
+                    save_rule_snapshot(rule_states, fingerprints, verified_at, logger, settings)
+
+        # Report in Monday board order regardless of the order the changes were applied in
+        rule_ids_not_mutated = [f'Event {i + 1}: {muting_rule_id}'
+                                for i, muting_rule_id in sorted(rules_not_mutated, key=lambda rule: rule[0])]
+        events_not_processed = [f'Event {i + 1}: {reason}'
+                                for i, reason in sorted(invalid_events + events_skipped, key=lambda event: event[0])]
+        return 0, rule_ids_not_mutated, events_not_processed, changes
     except Exception as e:
         logger.warning(f'\nThere was a general error:\n{e.__class__.__name__}\n{print_exc()}')
-        return 1, e, []
+        return 1, e, [], []
 
 
-def handler(event, context):
+def load_shard_config(path):
+    """Read the shard config and expand it into one settings dict per shard.
+
+    The file holds {"topic_arn": ..., "defaults": {...}, "shards": [{"name": ..., ...}]}. Shards take any
+    SHARD_SETTINGS option plus an optional "snapshot_key", with "defaults" underneath. A shard with
+    "account_groups": N is split into N shards that audit the same board for disjoint sets of New Relic accounts.
+    """
+    with open(path) as config_file:
+        config = json.load(config_file)
+
+    shards = []
+    for shard in config['shards']:
+        shard = {**config.get('defaults', {}), **shard}
+        unknown = set(shard) - set(SHARD_SETTINGS) - {'name', 'snapshot_key', 'account_groups'}
+        if unknown:
+            raise ValueError(f'Shard {shard.get("name")} has unknown option(s): {sorted(unknown)}')
+        group_count = shard.pop('account_groups', 1)
+        if group_count > 1:
+            shards.extend({**shard, 'name': f'{shard["name"]}-{group_index + 1}of{group_count}',
+                           'account_group': [group_index, group_count]} for group_index in range(group_count))
+        else:
+            shards.append(shard)
+
+    names = [shard['name'] for shard in shards]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Shard names must be unique: {names}')
+    return shards, config.get('topic_arn', TOPIC_ARN)
+
+
+def shard_settings(shard):
+    settings = DEFAULT_SETTINGS._replace(**{option: shard[option] for option in SHARD_SETTINGS if option in shard})
+    if settings.accounts is not None:
+        settings = settings._replace(accounts=frozenset(int(nr_account_num) for nr_account_num in settings.accounts))
+
+    # Each shard keeps its own snapshot and parsed rule cache file, since its rules and client special cases differ
+    suffix = re.sub(r'\W+', '_', shard['name'])
+    return settings._replace(
+        snapshot_key=shard.get('snapshot_key',
+                               '{0} {2}{1}'.format(*os.path.splitext(DEFAULT_SETTINGS.snapshot_key), shard['name'])),
+        snapshot_path='{0}_{2}{1}'.format(*os.path.splitext(DEFAULT_SETTINGS.snapshot_path), suffix),
+        rule_cache_path='{0}_{2}{1}'.format(*os.path.splitext(DEFAULT_SETTINGS.rule_cache_path), suffix)
+        if DEFAULT_SETTINGS.rule_cache_path else ''
+    )
+
+
+def get_board_settings(board_id):
+    # Settings of every shard auditing the board, since account shards of one board each own some of its rules
+    if not SHARD_CONFIG_PATH:
+        return [DEFAULT_SETTINGS] if str(board_id) == str(DEFAULT_SETTINGS.board_id) else [], TOPIC_ARN
+    shards, topic_arn = load_shard_config(SHARD_CONFIG_PATH)
+    return [settings for settings in map(shard_settings, shards) if str(settings.board_id) == str(board_id)], \
+        topic_arn
+
+
+def item_updated_after(item, since):
+    try:
+        return datetime.fromisoformat(item['updated_at'].replace('Z', '+00:00')) > since
+    except (KeyError, AttributeError, ValueError):
+        return False
+
+
+def recheck_updated_items(fetch_started, rule_index, logger, settings=DEFAULT_SETTINGS):
+    # A webhook can apply a newer Monday edit while the sweep is still working from its earlier fetch, and the
+    # sweep's write may then land on top of it. Clients whose items changed since that fetch are reconciled again
+    # from fresh Monday and New Relic reads; later edits trigger their own webhooks. Only recently updated items
+    # are fetched, so a run without edits costs a single small Monday query.
+    logger.info('Checking for Monday items updated during the audit...')
+    updated_clients = sorted({item['name'] for item in get_patching_events(logger, settings=settings,
+                                                                           updated_since=fetch_started)
+                              if item_updated_after(item, fetch_started)})
+    if not updated_clients:
+        return 0, []
+
+    logger.info(f'   Reconciling {len(updated_clients)} client(s) updated during the audit: {updated_clients}')
+    monday_items = [item for client_name in updated_clients
+                    for item in get_patching_events(logger, client_name=client_name, settings=settings)
+                    if item['name'] == client_name]
+    process_code, not_mutated, _, _ = check_nr_rules(monday_items, rule_index, logger, use_snapshot=False,
+                                                     settings=settings)
+    return process_code, not_mutated
+
+
+def audit_board(rule_index, options, logger, settings=DEFAULT_SETTINGS):
+    dry_run = options.get('dry_run', DRY_RUN)
+    fetch_started = datetime.now(timezone.utc)
+    monday_items = get_patching_events(logger, settings=settings)
+    process_code, not_mutated, not_processed, changes = check_nr_rules(
+        monday_items, rule_index, logger, dry_run=dry_run, full_verify=options.get('full_verify', False),
+        settings=settings)
+
+    if process_code == 0 and not dry_run:
+        recheck_code, recheck_not_mutated = recheck_updated_items(fetch_started, rule_index, logger, settings)
+        # The recheck numbers its events within the rechecked items, not by board position
+        if recheck_code != 0:
+            not_mutated.append(f'Recheck of items updated during the audit failed: '
+                               f'{recheck_not_mutated.__class__.__name__}: {recheck_not_mutated}')
+        else:
+            not_mutated.extend(f'Recheck of items updated during the audit (events numbered within the rechecked '
+                               f'items), {nm_item}' for nm_item in recheck_not_mutated)
+    return process_code, not_mutated, not_processed, changes
+
+
+def run_shard(shard, options, logger):
+    settings = shard_settings(shard)
+    run_metrics.reset()
+    dry_run = options.get('dry_run', DRY_RUN)
+    logger.info(f'Auditing shard {shard["name"]} (board {settings.board_id})...')
+
+    with run_metrics.phase('s3_load'):
+        rule_index = get_stored_rule_data(logger, refresh=options.get('refresh_rules', False), settings=settings)
+    process_code, not_mutated, not_processed, changes = audit_board(rule_index, options, logger, settings)
+    run_metrics.emit(logger, mode='shard')
+
+    # Results cross a process or invocation boundary, so they are kept JSON-serializable
+    if process_code != 0:
+        not_mutated = f'{not_mutated.__class__.__name__}: {not_mutated}'
+    return {
+        'shard': shard['name'],
+        'board_id': settings.board_id,
+        'process_code': process_code,
+        'rule_ids_not_mutated': not_mutated,
+        'events_not_processed': not_processed,
+        'changes': changes if dry_run else len(changes),
+        'seconds': run_metrics.report()['total_seconds']
+    }
+
+
+def shard_failure(shard, error):
+    return {'shard': shard['name'], 'board_id': shard.get('board_id', DEFAULT_SETTINGS.board_id), 'process_code': 1,
+            'rule_ids_not_mutated': str(error), 'events_not_processed': [], 'changes': [], 'seconds': None}
+
+
+def shard_worker(shard, options, connection):
+    global aws_session, transport
+
+    # Forked from the coordinator; connections are never shared with the parent process
+    aws_clients.clear()
+    aws_session = None
+    transport = None
     logger = initialize_logger()
-    muting_df = get_stored_rule_data(logger)
-    monday_items = get_patching_events(logger)
-    process_code, not_mutated, not_processed = check_nr_rules(monday_items, muting_df, logger)
+    try:
+        result = run_shard(shard, options, logger)
+    except BaseException as e:
+        logger.warning(f'\nShard {shard["name"]} failed:\n{e.__class__.__name__}\n{print_exc()}')
+        result = shard_failure(shard, f'{e.__class__.__name__}: {e}')
+    connection.send(result)
+    connection.close()
 
+
+def run_shard_processes(shards, options, logger):
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    # Processes are forked from this thread only, before any worker threads exist in the coordinator; Lambda has
+    # no /dev/shm, so results come back over pipes rather than a Pool or Queue
+    context = multiprocessing.get_context('fork')
+    pending = list(shards)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < SHARD_MAX_WORKERS:
+            shard = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=shard_worker, args=(shard, options, sender), name=shard['name'])
+            process.start()
+            sender.close()
+            running[receiver] = (shard, process)
+
+        for receiver in wait(list(running)):
+            shard, process = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+            receiver.close()
+            process.join()
+            results[shard['name']] = result or shard_failure(shard, f'Worker exited with code {process.exitcode}')
+    return [results[shard['name']] for shard in shards]
+
+
+def invoke_shard(shard, options, function_name, logger):
+    logger.info(f'   Invoking {function_name} for shard {shard["name"]}...')
+    try:
+        response = get_aws_client('lambda').invoke(FunctionName=function_name, InvocationType='RequestResponse',
+                                                   Payload=json.dumps({**options, 'shard': shard}).encode())
+        payload = json.loads(response['Payload'].read() or 'null')
+    except Exception as e:
+        return shard_failure(shard, f'{e.__class__.__name__}: {e}')
+    if response.get('FunctionError') or not isinstance(payload, dict):
+        return shard_failure(shard, payload.get('errorMessage') if isinstance(payload, dict) else payload)
+    return payload
+
+
+def aggregate_shard_results(results):
+    not_mutated = []
+    not_processed = []
+    seen_events = set()
+    for result in results:
+        if result['process_code'] == 0:
+            not_mutated.extend(f'{result["shard"]}: {nm_item}' for nm_item in result['rule_ids_not_mutated'])
+        else:
+            not_mutated.append(f'{result["shard"]}: {result["rule_ids_not_mutated"]}')
+        # Account shards of the same board all see that board's invalid events
+        for np_item in result['events_not_processed']:
+            event_key = (result['board_id'], json.dumps(np_item))
+            if event_key not in seen_events:
+                seen_events.add(event_key)
+                not_processed.append(f'{result["shard"]}: {np_item}')
+    return max(result['process_code'] for result in results), not_mutated, not_processed
+
+
+def coordinate_shards(options, context, logger):
+    shards, topic_arn = load_shard_config(SHARD_CONFIG_PATH)
+    logger.info(f'Auditing {len(shards)} shard(s), {SHARD_MAX_WORKERS} at a time, in {SHARD_MODE} mode...')
+
+    with run_metrics.phase('shards'):
+        if SHARD_MODE == 'lambda':
+            function_name = getattr(context, 'invoked_function_arn', None) or os.environ['AWS_LAMBDA_FUNCTION_NAME']
+            with ThreadPoolExecutor(max_workers=SHARD_MAX_WORKERS) as executor:
+                results = list(executor.map(lambda shard: invoke_shard(shard, options, function_name, logger),
+                                            shards))
+        else:
+            results = run_shard_processes(shards, options, logger)
+
+    shard_summary = '\n'.join(f'{result["shard"]}: code {result["process_code"]}, {result["seconds"]}s, '
+                              f'{result["changes"] if isinstance(result["changes"], int) else len(result["changes"])} '
+                              f'change(s)' for result in results)
+    logger.info(f'Shard results:\n{shard_summary}')
+
+    if options.get('dry_run', DRY_RUN):
+        run_metrics.emit(logger, mode='coordinator')
+        return {'dry_run': True, 'changes': {result['shard']: result['changes'] for result in results}}
+
+    process_code, not_mutated, not_processed = aggregate_shard_results(results)
+    subject, message = format_notification(process_code, not_mutated, not_processed, logger)
+    if METRICS_IN_NOTIFICATION:
+        message += f'\nShard results:\n{shard_summary}'
+    with run_metrics.phase('notify'):
+        response = get_aws_client('sns').publish(TopicArn=topic_arn, Subject=subject, Message=message)
+    logger.info(response)
+    run_metrics.emit(logger, mode='coordinator')
+    return {'process_code': process_code, 'rule_ids_not_mutated': not_mutated, 'events_not_processed': not_processed}
+
+
+def format_notification(process_code, not_mutated, not_processed, logger):
     not_mutated_msg = f'The following rule IDs were not mutated due to errors:\n'
     try:
         for nm_item in not_mutated:
@@ -424,13 +1664,132 @@ def handler(event, context):
         subject = 'Daily muting automation oddity'
         message = f'Something strange happened with the muting automation function and it did not complete. Please ' \
                   f'review the logs from this run.'
+    return subject, message
+
+
+def handler(event, context):
+    logger = initialize_logger()
+    run_metrics.reset()
+    options = event if isinstance(event, dict) else {}
+    dry_run = options.get('dry_run', DRY_RUN)
+
+    # A coordinator invocation fans out to shards; a shard invocation audits one shard and returns its result
+    if 'shard' in options:
+        return run_shard(options['shard'], options, logger)
+    if SHARD_CONFIG_PATH:
+        return coordinate_shards(options, context, logger)
+
+    with run_metrics.phase('s3_load'):
+        rule_index = get_stored_rule_data(logger, refresh=options.get('refresh_rules', False))
+    process_code, not_mutated, not_processed, changes = audit_board(rule_index, options, logger)
+
+    # A dry run only reports the plan; nothing was written so nobody is notified
+    if dry_run:
+        logger.info(f'Run metrics:\n{run_metrics.summary()}')
+        run_metrics.emit(logger, mode='dry_run')
+        return {'dry_run': True, 'changes': changes}
+
+    subject, message = format_notification(process_code, not_mutated, not_processed, logger)
+    if process_code == 0 and METRICS_IN_NOTIFICATION:
+        message += f'\nRun metrics:\n{run_metrics.summary()}'
 
     # Send an SNS notification upon code completion
-    response = sns.publish(TopicArn=TOPIC_ARN, Subject=subject, Message=message)
+    with run_metrics.phase('notify'):
+        response = get_aws_client('sns').publish(TopicArn=TOPIC_ARN, Subject=subject, Message=message)
     logger.info(response)
+    logger.info(f'Run metrics:\n{run_metrics.summary()}')
+    run_metrics.emit(logger)
+    if process_code != 0:
+        not_mutated = f'{not_mutated.__class__.__name__}: {not_mutated}'
+    return {'process_code': process_code, 'rule_ids_not_mutated': not_mutated, 'events_not_processed': not_processed,
+            'changes': len(changes)}
+
+
+def webhook_handler(event, context):
+    logger = initialize_logger()
+    run_metrics.reset()
+    body = (event.get('body') or event) if isinstance(event, dict) else {}
+    if isinstance(body, str):
+        body = json.loads(base64.b64decode(body) if event.get('isBase64Encoded') else body)
+    if not isinstance(body, dict):
+        body = {}
+
+    # Monday verifies a new webhook URL by expecting its challenge echoed back
+    if 'challenge' in body:
+        return {'statusCode': 200, 'body': json.dumps({'challenge': body['challenge']})}
+
+    webhook_event = body.get('event') or {}
+    item_id = webhook_event.get('pulseId') or webhook_event.get('itemId')
+    board_settings, topic_arn = get_board_settings(webhook_event.get('boardId'))
+    if not board_settings or not item_id:
+        logger.warning(f'Ignoring webhook that is not for an item on an audited board:\n{body}')
+        return {'statusCode': 200, 'body': json.dumps({'processed': False})}
+
+    logger.info(f'Processing webhook {webhook_event.get("type")} for Monday item {item_id}...')
+    client_name = webhook_event.get('pulseName') or get_item_name(item_id, logger)
+    if not client_name:
+        return {'statusCode': 200, 'body': json.dumps({'processed': False})}
+
+    # Every event for the same client can decide the state of this item's rules (e.g. Lenovo's first upcoming
+    # event), so the client's events are reconciled together. A sweep running at the same time may write its
+    # older view of these rules after this does; it re-reconciles items updated after its fetch to undo that (see
+    # recheck_updated_items). The snapshot is left to the sweep, which re-reads these rules because their events
+    # changed. Each shard of the board reconciles the client's events with its own rules and accounts.
+    monday_items = [monday_item for monday_item in get_patching_events(logger, client_name=client_name,
+                                                                       settings=board_settings[0])
+                    if monday_item['name'] == client_name]
+    process_code = 0
+    not_mutated = []
+    not_processed = []
+    changes = []
+    for settings in board_settings:
+        with run_metrics.phase('s3_load'):
+            rule_index = get_stored_rule_data(logger, settings=settings)
+        shard_code, shard_not_mutated, shard_not_processed, shard_changes = check_nr_rules(
+            monday_items, rule_index, logger, use_snapshot=False, settings=settings)
+        if shard_code != 0:
+            process_code = shard_code
+            not_mutated.append(f'{shard_not_mutated.__class__.__name__}: {shard_not_mutated}')
+        else:
+            not_mutated.extend(shard_not_mutated)
+        not_processed.extend(np_item for np_item in shard_not_processed if np_item not in not_processed)
+        changes.extend(shard_changes)
+
+    if process_code != 0 or not_mutated:
+        message = f'The muting automation webhook for {client_name} (Monday item {item_id}) did not complete ' \
+                  f'cleanly:\n\n{not_mutated}\n\nPlease review the logs from this run.'
+        response = get_aws_client('sns').publish(TopicArn=topic_arn, Subject='Muting automation webhook error',
+                                                 Message=message)
+        logger.info(response)
+
+    run_metrics.emit(logger, mode='webhook')
+    return {'statusCode': 200, 'body': json.dumps({
+        'processed': process_code == 0,
+        'item_id': item_id,
+        'changes': len(changes),
+        'rule_ids_not_mutated': not_mutated if process_code == 0 else [],
+        'events_not_processed': not_processed
+    })}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Audit New Relic muting rules against Monday patching events.')
+    parser.add_argument('--dry-run', action='store_true', help='print the planned changes as JSON and skip writes')
+    parser.add_argument('--convert-rules', metavar='SOURCE',
+                        help='validate a muting rule spreadsheet (or CSV) and write it as a CSV rule store')
+    parser.add_argument('--output', help='CSV written by --convert-rules (default: SOURCE with a .csv extension)')
+    args = parser.parse_args()
 
+    if args.convert_rules:
+        sys.exit(convert_rule_store(args.convert_rules,
+                                    args.output or f'{os.path.splitext(args.convert_rules)[0]}.csv'))
 
-event = ""
-context = ""
+    event = {'dry_run': True} if args.dry_run else ""
+    context = ""
+    # EMF metrics are printed to stdout, which the dry run keeps for the plan so it can be piped to a JSON parser
+    if args.dry_run and METRICS_FORMAT == 'emf':
+        METRICS_FORMAT = 'json'
 
-handler(event, context)
+    result = handler(event, context)
+    if args.dry_run:
+        print(json.dumps(result['changes'], indent=2))